@@ -70,7 +70,7 @@ print("HOME:", HOME)
 import sys
 !{sys.executable} -m pip install 'git+https://github.com/facebookresearch/segment-anything.git'
 
-!pip install -q jupyter_bbox_widget roboflow dataclasses-json supervision
+!pip install -q jupyter_bbox_widget roboflow dataclasses-json supervision ijson
 
 """### Download SAM weights"""
 
@@ -80,11 +80,18 @@ import sys
 # %cd {HOME}/weights
 
 !wget -q https://dl.fbaipublicfiles.com/segment_anything/sam_vit_h_4b8939.pth
+!wget -q https://dl.fbaipublicfiles.com/segment_anything/sam_vit_l_0b3195.pth
+!wget -q https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth
 
 import os
 
-CHECKPOINT_PATH = os.path.join(HOME, "weights", "sam_vit_h_4b8939.pth")
-print(CHECKPOINT_PATH, "; exist:", os.path.isfile(CHECKPOINT_PATH))
+CHECKPOINT_PATHS = {
+    "vit_h": os.path.join(HOME, "weights", "sam_vit_h_4b8939.pth"),
+    "vit_l": os.path.join(HOME, "weights", "sam_vit_l_0b3195.pth"),
+    "vit_b": os.path.join(HOME, "weights", "sam_vit_b_01ec64.pth"),
+}
+for checkpoint_path in CHECKPOINT_PATHS.values():
+    print(checkpoint_path, "; exist:", os.path.isfile(checkpoint_path))
 
 """## Download Example Data
 
@@ -101,23 +108,780 @@ print(CHECKPOINT_PATH, "; exist:", os.path.isfile(CHECKPOINT_PATH))
 !wget -q https://media.roboflow.com/notebooks/examples/dog-3.jpeg
 !wget -q https://media.roboflow.com/notebooks/examples/dog-4.jpeg
 
-"""## Load Model"""
+"""## Load Model
+
+### Throughput Profiles
+
+A profile picks the SAM backbone and the `SamAutomaticMaskGenerator` settings. `accurate` is the default `vit_h` setup; `balanced` and `fast` trade mask quality for speed with smaller backbones, a sparser point grid and bigger point batches, and are meant for CPU-only nodes. When `DEVICE` falls back to CPU we pick `balanced` - a `vit_l` instead of a `vit_h` - unless the `SAM_PROFILE` environment variable names a profile explicitly. The chosen profile and backbone are printed below.
+"""
 
 import torch
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Optional
 
 DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 print(DEVICE)
-MODEL_TYPE = "vit_h"
 
+
+@dataclass(frozen=True)
+class SamProfile:
+    model_type: str
+    points_per_side: int = 32
+    points_per_batch: int = 64
+    crop_n_layers: int = 0
+    pred_iou_thresh: float = 0.88
+    stability_score_thresh: float = 0.95
+    box_nms_thresh: float = 0.7
+    min_mask_region_area: int = 0
+
+    def generator_kwargs(self) -> Dict[str, Any]:
+        kwargs = asdict(self)
+        kwargs.pop("model_type")
+        return kwargs
+
+
+SAM_PROFILES = {
+    "accurate": SamProfile(model_type="vit_h"),
+    "balanced": SamProfile(model_type="vit_l", points_per_side=24, points_per_batch=128, pred_iou_thresh=0.86, stability_score_thresh=0.92),
+    "fast": SamProfile(model_type="vit_b", points_per_side=16, points_per_batch=256, pred_iou_thresh=0.86, stability_score_thresh=0.92, min_mask_region_area=100),
+}
+
+SAM_PROFILE = os.environ.get("SAM_PROFILE", "accurate" if DEVICE.type == "cuda" else "balanced")
+if SAM_PROFILE not in SAM_PROFILES:
+    raise ValueError(f"unknown SAM_PROFILE {SAM_PROFILE!r}, expected one of {sorted(SAM_PROFILES)}")
+MODEL_TYPE = SAM_PROFILES[SAM_PROFILE].model_type
+CHECKPOINT_PATH = CHECKPOINT_PATHS[MODEL_TYPE]
+print(f"profile: {SAM_PROFILE} ({'SAM_PROFILE' if 'SAM_PROFILE' in os.environ else 'default for ' + DEVICE.type}), backbone: {MODEL_TYPE}")
+
+from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+
+"""### Fast Startup
+
+`sam_model_registry[MODEL_TYPE](checkpoint=...)` deserialises the whole 2.4 GB `vit_h` checkpoint into fresh tensors and then copies it `.to(device)`. With `SAM_MMAP` the checkpoint is converted once into a plain, contiguous state dict (`*.mmap.pt`) that `torch.load(mmap=True)` maps zero-copy; the model skeleton is built on the `meta` device and the mapped tensors are assigned to it directly, so on CPU nothing is copied at all.
+
+With `USE_WARM_MODEL` the model also lives in a long-lived local process that serves it over a Unix socket next to the weights. The first run starts it, later runs (re-executed cells, restarted runtimes, other notebooks) attach to the same warm model. The server is a fresh Python process (`sam_server.py`, written next to the weights), not a fork of this kernel, so it shares neither the kernel's sockets and threads nor its CUDA state. Its connections are authenticated with a random key that is handed to it on stdin and kept in a `sam-<model>.key` file only the current user can read. Remote results use SAM's `uncompressed_rle` output, so they stay small on the wire - `CompactMasks.from_sam_result` reads them directly.
+
+With `QUANTIZE_CPU` (CPU only) the linear layers of the image encoder - which dominates CPU wall time and memory - are dynamically quantized to int8. The prompt encoder and the mask decoder stay in fp32 and are shared with the fp32 model. The accuracy of this mode is checked in the *Int8 Quantization Report* below.
+
+**NOTE:** Requires `torch>=2.1`.
+"""
+
+import json
+import subprocess
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.managers import BaseManager
+
+from segment_anything.modeling import Sam
+
+SAM_MMAP = True
+USE_WARM_MODEL = False
+QUANTIZE_CPU = False
+STARTUP_REPORT = False
+
+SAM_MODELS = {}
+
+
+def convert_checkpoint(model_type: str) -> str:
+    checkpoint_path = CHECKPOINT_PATHS[model_type]
+    mmap_path = os.path.splitext(checkpoint_path)[0] + ".mmap.pt"
+    if not os.path.isfile(mmap_path):
+        state_dict = torch.load(checkpoint_path, map_location="cpu")
+        torch.save({key: value.contiguous() for key, value in state_dict.items()}, mmap_path + ".tmp")
+        os.replace(mmap_path + ".tmp", mmap_path)
+    return mmap_path
+
+
+def build_sam(model_type: str, mmap: bool = SAM_MMAP, device: torch.device = DEVICE):
+    if not mmap:
+        return sam_model_registry[model_type](checkpoint=CHECKPOINT_PATHS[model_type]).to(device=device)
+
+    with torch.device("meta"):
+        model = sam_model_registry[model_type]()
+    state_dict = torch.load(convert_checkpoint(model_type), mmap=True, weights_only=True, map_location="cpu")
+    model.load_state_dict(state_dict, assign=True)
+    # pixel_mean / pixel_std are non-persistent buffers, so they are not part of the checkpoint
+    model.register_buffer("pixel_mean", torch.Tensor([123.675, 116.28, 103.53]).view(-1, 1, 1), False)
+    model.register_buffer("pixel_std", torch.Tensor([58.395, 57.12, 57.375]).view(-1, 1, 1), False)
+    return model.eval().to(device=device)
+
+
+def quantize_sam(model: Sam) -> Sam:
+    if model.device.type != "cpu":
+        raise ValueError("int8 dynamic quantization is only supported on CPU")
+    image_encoder = torch.ao.quantization.quantize_dynamic(model.image_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    return Sam(
+        image_encoder=image_encoder,
+        prompt_encoder=model.prompt_encoder,
+        mask_decoder=model.mask_decoder,
+        pixel_mean=model.pixel_mean.flatten().tolist(),
+        pixel_std=model.pixel_std.flatten().tolist()
+    ).eval()
+
+
+def sam_model_key(model_type: str, quantize: Optional[bool] = None) -> str:
+    quantize = QUANTIZE_CPU and DEVICE.type == "cpu" if quantize is None else quantize
+    return model_type + "-int8" if quantize else model_type
+
+
+def load_sam(model_type: str, quantize: Optional[bool] = None):
+    key = sam_model_key(model_type, quantize)
+    if key not in SAM_MODELS:
+        # only MODEL_TYPE - which `sam` and `mask_generator` hold anyway - and the backbone asked for are
+        # cached (with their int8 variants), a vit_h alone is 2.4 GB
+        for other in [other for other in SAM_MODELS if other.split("-")[0] not in (model_type, MODEL_TYPE)]:
+            del SAM_MODELS[other]
+        if DEVICE.type == "cuda":
+            torch.cuda.empty_cache()
+        if key == model_type:
+            SAM_MODELS[key] = build_sam(model_type)
+        else:
+            SAM_MODELS[key] = quantize_sam(load_sam(model_type, quantize=False))
+    return SAM_MODELS[key]
+
+
+def current_rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+SAM_SERVER_SOURCE = """
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+import torch
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
-sam = sam_model_registry[MODEL_TYPE](checkpoint=CHECKPOINT_PATH).to(device=DEVICE)
+
+config = json.loads(sys.stdin.readline())
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+# same as build_sam in the notebook - the mmap checkpoint is assigned to a meta skeleton
+with torch.device("meta"):
+    model = sam_model_registry[config["model_type"]]()
+model.load_state_dict(torch.load(config["checkpoint"], mmap=True, weights_only=True, map_location="cpu"), assign=True)
+model.register_buffer("pixel_mean", torch.Tensor([123.675, 116.28, 103.53]).view(-1, 1, 1), False)
+model.register_buffer("pixel_std", torch.Tensor([58.395, 57.12, 57.375]).view(-1, 1, 1), False)
+model = model.eval().to(device=device)
+
+
+class SamModelService:
+    def __init__(self):
+        self.predictor = SamPredictor(model)
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def info(self):
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        return {
+            "model_type": config["model_type"],
+            "device": str(device),
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started,
+            "rss_mb": rss / 1024 ** 2,
+        }
+
+    def generate(self, image_rgb, profile_name="accurate"):
+        # the profile only contributes generator settings, the backbone is the one this process serves
+        generator = SamAutomaticMaskGenerator(model, output_mode="uncompressed_rle", **config["profiles"][profile_name])
+        with self.lock:
+            return generator.generate(image_rgb)
+
+    def predict(self, image_rgb, **prompt):
+        with self.lock:
+            self.predictor.set_image(image_rgb)
+            return self.predictor.predict(**prompt)
+
+
+service = SamModelService()
+
+
+class SamModelManager(BaseManager):
+    pass
+
+
+SamModelManager.register("SamModel", callable=lambda: service)
+SamModelManager(address=config["address"], authkey=bytes.fromhex(config["authkey"])).get_server().serve_forever()
+"""
+
+
+class SamModelManager(BaseManager):
+    pass
+
+
+SamModelManager.register("SamModel")
+
+
+def sam_server_address(model_type: str) -> str:
+    return os.path.join(HOME, "weights", f"sam-{model_type}.sock")
+
+
+def sam_server_authkey(model_type: str) -> Optional[bytes]:
+    try:
+        with open(os.path.splitext(sam_server_address(model_type))[0] + ".key", "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def connect_sam_server(model_type: str, timeout: float = 0.0, process: Optional[subprocess.Popen] = None):
+    deadline = time.time() + timeout
+    while True:
+        authkey = sam_server_authkey(model_type)
+        try:
+            if authkey is None:
+                raise FileNotFoundError(sam_server_address(model_type))
+            manager = SamModelManager(address=sam_server_address(model_type), authkey=authkey)
+            manager.connect()
+            return manager.SamModel()
+        # a server started with another key is treated like no server
+        except (FileNotFoundError, ConnectionRefusedError, AuthenticationError):
+            if time.time() >= deadline or (process is not None and process.poll() is not None):
+                return None
+            time.sleep(0.5)
+
+
+def start_sam_server(model_type: str, timeout: float = 600.0):
+    proxy = connect_sam_server(model_type)
+    if proxy is not None:
+        return proxy
+
+    address = sam_server_address(model_type)
+    # a socket left behind by a dead server
+    if os.path.exists(address):
+        os.remove(address)
+
+    # a fresh key for every server, readable by the current user only
+    authkey = os.urandom(32)
+    key_path = os.path.splitext(address)[0] + ".key"
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    with os.fdopen(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+        f.write(authkey)
+
+    script_path = os.path.join(HOME, "weights", "sam_server.py")
+    with open(script_path, "w") as f:
+        f.write(SAM_SERVER_SOURCE)
+
+    config = {
+        "model_type": model_type,
+        "checkpoint": convert_checkpoint(model_type),
+        "address": address,
+        "authkey": authkey.hex(),
+        "profiles": {name: profile.generator_kwargs() for name, profile in SAM_PROFILES.items()},
+    }
+    # a new interpreter in its own session, so the server outlives this kernel
+    with open(os.path.splitext(address)[0] + ".log", "ab") as log:
+        process = subprocess.Popen([sys.executable, script_path], stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    process.stdin.write((json.dumps(config) + "\n").encode())
+    process.stdin.close()
+
+    return connect_sam_server(model_type, timeout=timeout, process=process)
+
+
+class RemoteMaskGenerator:
+    def __init__(self, proxy, profile_name: str = "accurate"):
+        self.proxy = proxy
+        self.profile_name = profile_name
+
+    def generate(self, image_rgb):
+        return self.proxy.generate(image_rgb, self.profile_name)
+
+
+sam_server = start_sam_server(MODEL_TYPE) if USE_WARM_MODEL else None
+if sam_server is not None:
+    print(sam_server.info())
+
+sam = load_sam(MODEL_TYPE)
+
+"""### Startup Report
+
+Loads the model in a fresh forked process for each mode - `cold` (the original `sam_model_registry` path), `mmap` and `warm` (attach to the running model process) - and reports startup time and memory. `rss_anon_mb` is the private memory of the process; pages of a memory-mapped checkpoint are counted in `rss_file_mb` and shared with the page cache. The forked processes load on CPU, because CUDA cannot be used after a fork. Every mode loads the whole checkpoint again, so the report only runs with `STARTUP_REPORT = True`.
+"""
+
+import multiprocessing
+import resource
+
+import pandas as pd
+
+
+def _memory_status() -> Dict[str, float]:
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("RssAnon", "RssFile"):
+                status[key] = int(value.split()[0]) / 1024
+    return status
+
+
+def _measure_startup(mode: str, model_type: str, connection) -> None:
+    # a forked process starts with the pages of this notebook, only the growth is reported
+    before = _memory_status()
+    start = time.perf_counter()
+    if mode == "warm":
+        proxy = connect_sam_server(model_type)
+        info = proxy.info() if proxy is not None else None
+    else:
+        info = build_sam(model_type, mmap=(mode == "mmap"), device=torch.device("cpu"))
+    seconds = time.perf_counter() - start
+
+    after = _memory_status()
+    connection.send({
+        "mode": mode,
+        "available": info is not None,
+        "startup_s": seconds,
+        "rss_anon_mb": after["RssAnon"] - before["RssAnon"],
+        "rss_file_mb": after["RssFile"] - before["RssFile"],
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - before["RssAnon"] - before["RssFile"],
+    })
+    connection.close()
+
+
+def startup_report(model_type: str = MODEL_TYPE, modes=("cold", "mmap", "warm")) -> pd.DataFrame:
+    context = multiprocessing.get_context("fork")
+    rows = []
+    for mode in modes:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_measure_startup, args=(mode, model_type, sender))
+        process.start()
+        rows.append(receiver.recv())
+        process.join()
+    return pd.DataFrame(rows)
+
+
+# every mode loads the full checkpoint again, cold included, so the report is opt-in
+if STARTUP_REPORT:
+    print(startup_report())
+
+"""### Stage Profiling
+
+Where does the time go between decoding, `set_image`, `generate`, `predict`, building `sv.Detections` and annotating? The notebook wraps each of these stages in `profiler.stage(name, image)`. With `PROFILE_STAGES = True` every stage records wall time, CPU time (all threads of the process, so torch's intra-op threads count), the peak CUDA memory (on CPU the peak RSS growth of the process, sampled by `PeakMemorySampler`) and - with `trace_memory` - the peak Python allocation via `tracemalloc`. A stage can add its own fields, e.g. the number of masks or prompts. Records are exported as JSON lines and aggregated per stage with `summary()`. When profiling is off, `stage` returns a `nullcontext` and costs about a microsecond.
+
+**NOTE:** stages should not be nested - the peak memory counters are reset when a stage starts.
+"""
+
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+PROFILE_STAGES = False
+PROFILE_DIR = os.path.join(HOME, "profiles")
+
+
+class PeakMemorySampler:
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.baseline_rss = 0
+        self.peak_rss = 0
+        self.peak_cuda = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> "PeakMemorySampler":
+        self.baseline_rss = self.peak_rss = current_rss_bytes()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss_bytes())
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss_bytes())
+        if torch.cuda.is_available():
+            self.peak_cuda = torch.cuda.max_memory_allocated()
+
+    @property
+    def peak_rss_mb(self) -> float:
+        return (self.peak_rss - self.baseline_rss) / 1024 ** 2
+
+    @property
+    def peak_cuda_mb(self) -> float:
+        return self.peak_cuda / 1024 ** 2
+
+
+class StageProfiler:
+    def __init__(self, enabled: bool = PROFILE_STAGES, trace_memory: bool = False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.records: List[Dict[str, Any]] = []
+
+    def stage(self, name: str, image: Optional[str] = None, **fields: Any) -> ContextManager[Dict[str, Any]]:
+        if not self.enabled:
+            return nullcontext({})
+        return self._measure(name, image, fields)
+
+    @contextmanager
+    def _measure(self, name: str, image: Optional[str], fields: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        record = {"stage": name, "image": image, **fields}
+        cuda = torch.cuda.is_available()
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        # without CUDA the interesting peak is the RSS of this process
+        sampler = None if cuda else PeakMemorySampler(interval=0.01).__enter__()
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            # wait for queued kernels, or their time ends up in the next stage
+            if cuda:
+                torch.cuda.synchronize()
+            record["wall_s"] = time.perf_counter() - wall
+            record["cpu_s"] = time.process_time() - cpu
+            if self.trace_memory:
+                record["python_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            if started_tracing:
+                tracemalloc.stop()
+            if cuda:
+                record["torch_peak_mb"] = torch.cuda.max_memory_allocated() / 1024 ** 2
+            else:
+                sampler.__exit__(None, None, None)
+                record["rss_peak_mb"] = sampler.peak_rss_mb
+            self.records.append(record)
+
+    def table(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records)
+
+    def summary(self) -> pd.DataFrame:
+        table = self.table()
+        if table.empty:
+            return table
+        summary = table.groupby("stage", sort=False)["wall_s"].agg(
+            calls="size",
+            total_s="sum",
+            mean_s="mean",
+            p50_s="median",
+            p95_s=lambda x: x.quantile(0.95)
+        )
+        summary["cpu_s"] = table.groupby("stage", sort=False)["cpu_s"].sum()
+        summary["cpu/wall"] = summary["cpu_s"] / summary["total_s"]
+        for column in ("python_peak_mb", "torch_peak_mb", "rss_peak_mb"):
+            if column in table:
+                summary[column] = table.groupby("stage", sort=False)[column].max()
+        for column in ("masks", "prompts"):
+            if column in table:
+                summary[column] = table.groupby("stage", sort=False)[column].sum(min_count=1)
+        return summary
+
+    def save(self, directory: str = PROFILE_DIR, name: str = "stages") -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}.jsonl")
+        with open(path, "w") as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=str) + "\n")
+        self.summary().to_csv(os.path.join(directory, f"{name}_summary.csv"))
+        return path
+
+    def clear(self) -> None:
+        self.records.clear()
+
+
+profiler = StageProfiler()
+
+"""### Image Embedding Cache
+
+`SamPredictor.set_image` runs the heavy image encoder every time it is called - inside `SamAutomaticMaskGenerator.generate`, in `mask_predictor.set_image` and on every re-run of a cell. `CachedSamPredictor` is a drop-in `SamPredictor` that keeps the image embeddings keyed by the image content hash, model type and checkpoint. Embeddings live in memory (LRU, `max_items`) and on local disk (`max_disk_bytes`), so a repeated box or point prompt on a scan we've already seen only runs the prompt decoder.
+
+**NOTE:** Embeddings of `vit_h` are `1x256x64x64` `float32` (~4 MB per image).
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+EMBEDDING_CACHE_DIR = os.path.join(HOME, "cache", "embeddings")
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: Optional[str] = EMBEDDING_CACHE_DIR, max_items: int = 32, max_disk_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        if self.cache_dir and os.path.isfile(self._disk_path(key)):
+            entry = torch.load(self._disk_path(key), map_location="cpu")
+            # touch the file so disk eviction is least-recently-used as well
+            os.utime(self._disk_path(key))
+            self._put_memory(key, entry)
+            return entry
+
+        return None
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        self._put_memory(key, entry)
+        if self.cache_dir:
+            tmp_path = self._disk_path(key) + ".tmp"
+            torch.save(entry, tmp_path)
+            os.replace(tmp_path, self._disk_path(key))
+            self._evict_disk()
+
+    def _put_memory(self, key: str, entry: Dict[str, Any]) -> None:
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self) -> None:
+        files = [
+            entry
+            for entry
+            in os.scandir(self.cache_dir)
+            if entry.name.endswith(".pt")
+        ]
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in sorted(files, key=lambda x: x.stat().st_mtime):
+            if total <= self.max_disk_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.cache_dir:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".pt"):
+                    os.remove(entry.path)
+
+
+class CachedSamPredictor(SamPredictor):
+    def __init__(self, sam_model, model_type: str, checkpoint: str, cache: EmbeddingCache):
+        super().__init__(sam_model)
+        checkpoint_size = os.path.getsize(checkpoint) if os.path.isfile(checkpoint) else 0
+        self.model_key = f"{model_type}:{os.path.basename(checkpoint)}:{checkpoint_size}"
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def image_key(self, image: np.ndarray, image_format: str = "RGB") -> str:
+        digest = hashlib.sha1()
+        digest.update(self.model_key.encode())
+        digest.update(image_format.encode())
+        digest.update(str(image.shape).encode())
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def set_image(self, image: np.ndarray, image_format: str = "RGB", image_key: Optional[str] = None) -> None:
+        # callers that already hashed the image pass the key, so it is not hashed twice
+        key = image_key if image_key is not None else self.image_key(image, image_format)
+        entry = self.cache.get(key)
+
+        if entry is None:
+            self.misses += 1
+            super().set_image(image, image_format)
+            self.cache.put(key, {
+                "features": self.features.detach().cpu(),
+                "original_size": self.original_size,
+                "input_size": self.input_size
+            })
+            return
+
+        self.hits += 1
+        self.reset_image()
+        self.features = entry["features"].to(self.device)
+        self.original_size = entry["original_size"]
+        self.input_size = entry["input_size"]
+        self.is_image_set = True
+
+
+embedding_cache = EmbeddingCache()
+
+
+def build_mask_generator(profile_name: str, cache: Optional[EmbeddingCache] = embedding_cache) -> SamAutomaticMaskGenerator:
+    profile = SAM_PROFILES[profile_name]
+    model = load_sam(profile.model_type)
+    generator = SamAutomaticMaskGenerator(model, **profile.generator_kwargs())
+    if cache is not None:
+        generator.predictor = CachedSamPredictor(model, sam_model_key(profile.model_type), CHECKPOINT_PATHS[profile.model_type], cache)
+    return generator
 
 """## Automated Mask Generation
 
-To run automatic mask generation, provide a SAM model to the `SamAutomaticMaskGenerator` class. Set the path below to the SAM checkpoint. Running on CUDA and with the default model is recommended.
+To run automatic mask generation, provide a SAM model to the `SamAutomaticMaskGenerator` class. Set the path below to the SAM checkpoint. Running on CUDA and with the default model is recommended. `build_mask_generator` does that for the selected `SAM_PROFILE`.
 """
 
-mask_generator = SamAutomaticMaskGenerator(sam)
+mask_generator = build_mask_generator(SAM_PROFILE)
+
+"""### Decoded Image Store
+
+The same scan is read in several places - automatic generation, the box prompt, the widget preview, the annotators. `ImageStore` reads every file once: the raw bytes are hashed and decoded to BGR, the RGB image is a reversed-channel view of the same pixels, and every caller gets the same read-only arrays back without copying (annotate a `.copy()`). With `IMAGE_STORE_DISK_CACHE` (off by default) the decoded BGR array is also saved as a `.npy` file named by the content hash under `IMAGE_STORE_DIR` and opened memory-mapped, so a restarted runtime skips decoding, and identical files under different names share one entry. `data_uri` builds the widget preview from the bytes that were already read.
+"""
+
+import base64
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+IMAGE_STORE_DIR = os.path.join(HOME, "cache", "images")
+IMAGE_STORE_DISK_CACHE = False
+
+
+class DecodedImage:
+    __slots__ = ("path", "key", "bgr", "rgb", "_encoded", "_data_uri")
+
+    def __init__(self, path: str, key: str, bgr: np.ndarray, rgb: np.ndarray, encoded: bytes):
+        self.path = path
+        self.key = key
+        self.bgr = bgr
+        self.rgb = rgb
+        self._encoded = encoded
+        self._data_uri = None
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.rgb.shape
+
+    @property
+    def data_uri(self) -> str:
+        if self._data_uri is None:
+            mime = mimetypes.guess_type(self.path)[0] or "image/jpeg"
+            self._data_uri = f"data:{mime};base64," + base64.b64encode(self._encoded).decode()
+        return self._data_uri
+
+
+class ImageStore:
+    def __init__(self, cache_dir: Optional[str] = None, max_items: int = 64, max_disk_bytes: int = 4 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self.images: "OrderedDict[str, Tuple[Tuple[int, int], DecodedImage]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.decoded = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.bgr.npy")
+
+    def get(self, path: str) -> DecodedImage:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        # a file rewritten in place gets decoded again
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            if path in self.images and self.images[path][0] == version:
+                self.images.move_to_end(path)
+                self.hits += 1
+                return self.images[path][1]
+
+        image = self._load(path)
+        with self.lock:
+            self.images[path] = (version, image)
+            self.images.move_to_end(path)
+            while len(self.images) > self.max_items:
+                self.images.popitem(last=False)
+        return image
+
+    def rgb(self, path: str) -> np.ndarray:
+        return self.get(path).rgb
+
+    def bgr(self, path: str) -> np.ndarray:
+        return self.get(path).bgr
+
+    def data_uri(self, path: str) -> str:
+        return self.get(path).data_uri
+
+    def _load(self, path: str) -> DecodedImage:
+        with open(path, "rb") as f:
+            encoded = f.read()
+        key = hashlib.sha1(encoded).hexdigest()
+
+        bgr = self._load_array(key)
+        if bgr is None:
+            bgr = cv2.imdecode(np.frombuffer(encoded, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if bgr is None:
+                raise ValueError(f"unreadable image: {path}")
+            with self.lock:
+                self.decoded += 1
+            bgr = self._save_array(key, bgr)
+
+        bgr.setflags(write=False)
+        # only BGR is kept, RGB is a view with the channels reversed
+        return DecodedImage(path, key, bgr, bgr[..., ::-1], encoded)
+
+    def _load_array(self, key: str) -> Optional[np.ndarray]:
+        if not self.cache_dir or not os.path.isfile(self._disk_path(key)):
+            return None
+        # touch the file so disk eviction is least-recently-used
+        os.utime(self._disk_path(key))
+        return np.load(self._disk_path(key), mmap_mode="r")
+
+    def _save_array(self, key: str, bgr: np.ndarray) -> np.ndarray:
+        if not self.cache_dir:
+            return bgr
+        tmp_path = self._disk_path(key) + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, bgr)
+        os.replace(tmp_path, self._disk_path(key))
+        self._evict_disk()
+        # hand out the memory-mapped copy, the decoded array can be freed
+        mapped = self._load_array(key)
+        return bgr if mapped is None else mapped
+
+    def _evict_disk(self) -> None:
+        # all files of one image are evicted together, the oldest image first
+        entries: Dict[str, List[os.DirEntry]] = {}
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npy"):
+                entries.setdefault(entry.name.split(".")[0], []).append(entry)
+        total = sum(entry.stat().st_size for group in entries.values() for entry in group)
+        for group in sorted(entries.values(), key=lambda group: max(entry.stat().st_mtime for entry in group)):
+            if total <= self.max_disk_bytes:
+                break
+            for entry in group:
+                total -= entry.stat().st_size
+                # pages already mapped by live arrays stay valid after the unlink
+                os.remove(entry.path)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.images.clear()
+        if self.cache_dir:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".npy"):
+                    os.remove(entry.path)
+
+
+image_store = ImageStore(IMAGE_STORE_DIR if IMAGE_STORE_DISK_CACHE else None)
 
 import os
 import cv2
@@ -125,7 +889,6 @@ import cv2
 # IMAGE_NAME = "dog.jpeg"
 # IMAGE_PATH = os.path.join(HOME, "data", IMAGE_NAME)
 
-IMAGE_NAME = cv2.imread('/content/drive/My Drive/PD Dataset/1.jpg')
 IMAGE_PATH = '/content/drive/My Drive/PD Dataset/1.jpg'
 print(IMAGE_PATH)
 
@@ -137,10 +900,13 @@ print(IMAGE_PATH)
 import cv2
 import supervision as sv
 
-image_bgr = cv2.imread(IMAGE_PATH)
-image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+with profiler.stage("decode", IMAGE_PATH):
+    image = image_store.get(IMAGE_PATH)
+image_bgr, image_rgb = image.bgr, image.rgb
 
-sam_result = mask_generator.generate(image_rgb)
+with profiler.stage("generate", IMAGE_PATH) as record:
+    sam_result = mask_generator.generate(image_rgb)
+    record["masks"] = len(sam_result)
 
 """### Output format
 
@@ -157,16 +923,308 @@ sam_result = mask_generator.generate(image_rgb)
 
 print(sam_result[0].keys())
 
+"""### Compact Mask Storage
+
+A full resolution `bool` mask per result adds up to hundreds of MB per high-res scan. `CompactMasks` keeps every mask bit-packed and cropped to its bounding box, next to `area`, `xyxy`, `predicted_iou`, `stability_score` and (for box prompts) `class_id` metadata. Area, boxes and sort order come from the metadata; masks are decoded only when asked for - one at a time with `mask(i)`, or all at once with `decode()` / `to_detections()`.
+"""
+
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+from segment_anything.utils.amg import rle_to_mask
+
+
+class CompactMasks:
+    def __init__(
+        self,
+        shape: Tuple[int, int],
+        xyxy: np.ndarray,
+        area: np.ndarray,
+        packed: List[np.ndarray],
+        confidence: Optional[np.ndarray] = None,
+        stability_score: Optional[np.ndarray] = None,
+        class_id: Optional[np.ndarray] = None
+    ):
+        self.shape = tuple(shape)
+        self.xyxy = xyxy
+        self.area = area
+        self.packed = packed
+        self.confidence = confidence
+        self.stability_score = stability_score
+        self.class_id = class_id
+
+    @staticmethod
+    def _pack(mask: np.ndarray, box: np.ndarray) -> np.ndarray:
+        x_min, y_min, x_max, y_max = box
+        return np.packbits(mask[y_min:y_max + 1, x_min:x_max + 1], axis=None)
+
+    @staticmethod
+    def masks_to_xyxy(masks: np.ndarray) -> np.ndarray:
+        rows = masks.any(axis=2)
+        cols = masks.any(axis=1)
+        height, width = masks.shape[1:]
+        xyxy = np.stack([
+            cols.argmax(axis=1),
+            rows.argmax(axis=1),
+            width - 1 - cols[:, ::-1].argmax(axis=1),
+            height - 1 - rows[:, ::-1].argmax(axis=1)
+        ], axis=1)
+        # empty masks get an empty box
+        xyxy[~rows.any(axis=1)] = 0
+        return xyxy.astype(int)
+
+    @classmethod
+    def from_masks(
+        cls,
+        masks: np.ndarray,
+        confidence: Optional[np.ndarray] = None,
+        stability_score: Optional[np.ndarray] = None,
+        class_id: Optional[np.ndarray] = None
+    ) -> "CompactMasks":
+        masks = np.asarray(masks, dtype=bool)
+        xyxy = cls.masks_to_xyxy(masks) if len(masks) else np.zeros((0, 4), dtype=int)
+        return cls(
+            shape=masks.shape[1:],
+            xyxy=xyxy,
+            area=masks.sum(axis=(1, 2)).astype(int),
+            packed=[cls._pack(mask, box) for mask, box in zip(masks, xyxy)],
+            confidence=None if confidence is None else np.asarray(confidence, dtype=np.float32),
+            stability_score=None if stability_score is None else np.asarray(stability_score, dtype=np.float32),
+            class_id=None if class_id is None else np.asarray(class_id, dtype=int)
+        )
+
+    @classmethod
+    def from_sam_result(cls, sam_result: List[Dict[str, Any]], shape: Optional[Tuple[int, int]] = None) -> "CompactMasks":
+        xyxy, packed = [], []
+        for mask in sam_result:
+            segmentation = mask['segmentation']
+            # `output_mode="uncompressed_rle"` results are decoded one mask at a time
+            if isinstance(segmentation, dict):
+                segmentation = rle_to_mask(segmentation)
+            shape = segmentation.shape
+            x, y, w, h = mask['bbox']
+            box = np.array([x, y, x + w, y + h], dtype=int)
+            xyxy.append(box)
+            packed.append(cls._pack(segmentation, box))
+
+        return cls(
+            shape=shape if shape is not None else (0, 0),
+            xyxy=np.array(xyxy, dtype=int).reshape(-1, 4),
+            area=np.array([mask['area'] for mask in sam_result], dtype=int),
+            packed=packed,
+            confidence=np.array([mask['predicted_iou'] for mask in sam_result], dtype=np.float32),
+            stability_score=np.array([mask['stability_score'] for mask in sam_result], dtype=np.float32)
+        )
+
+    @classmethod
+    def from_detections(cls, detections: sv.Detections) -> "CompactMasks":
+        return cls.from_masks(detections.mask, confidence=detections.confidence, class_id=detections.class_id)
+
+    def __len__(self) -> int:
+        return len(self.packed)
+
+    def __getitem__(self, index: Union[int, slice, Sequence[int], np.ndarray]) -> "CompactMasks":
+        index = np.arange(len(self))[index].reshape(-1)
+        return CompactMasks(
+            shape=self.shape,
+            xyxy=self.xyxy[index],
+            area=self.area[index],
+            packed=[self.packed[i] for i in index],
+            confidence=None if self.confidence is None else self.confidence[index],
+            stability_score=None if self.stability_score is None else self.stability_score[index],
+            class_id=None if self.class_id is None else self.class_id[index]
+        )
+
+    def sorted_by_area(self, reverse: bool = True) -> "CompactMasks":
+        order = np.argsort(self.area, kind="stable")
+        return self[order[::-1] if reverse else order]
+
+    def mask(self, index: int) -> np.ndarray:
+        mask = np.zeros(self.shape, dtype=bool)
+        self._paste(index, mask)
+        return mask
+
+    def crop(self, index: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+        x_min, y_min, x_max, y_max = self.xyxy[index]
+        height, width = y_max - y_min + 1, x_max - x_min + 1
+        crop = np.unpackbits(self.packed[index], count=height * width).reshape(height, width)
+        return crop.view(bool), (int(x_min), int(y_min))
+
+    def _paste(self, index: int, out: np.ndarray) -> None:
+        crop, (x_min, y_min) = self.crop(index)
+        out[y_min:y_min + crop.shape[0], x_min:x_min + crop.shape[1]] = crop
+
+    def decode(self) -> np.ndarray:
+        masks = np.zeros((len(self),) + self.shape, dtype=bool)
+        for index in range(len(self)):
+            self._paste(index, masks[index])
+        return masks
+
+    def to_detections(self) -> sv.Detections:
+        return sv.Detections(
+            xyxy=self.xyxy.astype(float),
+            mask=self.decode(),
+            confidence=self.confidence,
+            class_id=self.class_id
+        )
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        # the ragged crops become one buffer plus offsets, so they can go into npz columns
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum([len(packed) for packed in self.packed], out=offsets[1:])
+        arrays = {
+            "shape": np.array(self.shape, dtype=np.int64),
+            "xyxy": np.asarray(self.xyxy, dtype=np.int64).reshape(-1, 4),
+            "area": np.asarray(self.area, dtype=np.int64),
+            "packed": np.concatenate(self.packed) if len(self) else np.zeros(0, dtype=np.uint8),
+            "packed_offsets": offsets,
+        }
+        if self.confidence is not None:
+            arrays["confidence"] = self.confidence
+        if self.stability_score is not None:
+            arrays["stability_score"] = self.stability_score
+        if self.class_id is not None:
+            arrays["class_id"] = np.asarray(self.class_id, dtype=np.int64)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Mapping[str, np.ndarray]) -> "CompactMasks":
+        packed, offsets = arrays["packed"], arrays["packed_offsets"]
+        return cls(
+            shape=tuple(int(size) for size in arrays["shape"]),
+            xyxy=arrays["xyxy"],
+            area=arrays["area"],
+            packed=[packed[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+            confidence=arrays["confidence"] if "confidence" in arrays else None,
+            stability_score=arrays["stability_score"] if "stability_score" in arrays else None,
+            class_id=arrays["class_id"] if "class_id" in arrays else None
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return sum(packed.nbytes for packed in self.packed) + self.xyxy.nbytes + self.area.nbytes
+
+
+compact_masks = CompactMasks.from_sam_result(sam_result).sorted_by_area()
+
+dense_bytes = sum(mask['segmentation'].nbytes for mask in sam_result)
+print(f"{len(compact_masks)} masks: {dense_bytes / 1024 ** 2:.1f} MB dense, {compact_masks.nbytes / 1024 ** 2:.2f} MB compact")
+
+"""### Resumable Result Store
+
+Segmentation results are written to disk as they are produced, so a crashed or interrupted run picks up where it stopped. Every image gets one `.npz` shard with its `CompactMasks` columns (bit-packed crops, `xyxy` boxes, areas, scores) and the prompt that produced them, and a line in `manifest.jsonl`. Shards live in a directory named by the hash of the run config (model, profile, prompts, ...), so changing the config starts a fresh set of results instead of mixing them. Reading is lazy - `get(image)` loads one shard, `items()` walks them one at a time.
+"""
+
+import json
+import threading
+from dataclasses import asdict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+SEGMENTATION_STORE_DIR = os.path.join(HOME, "results", "segmentation")
+
+
+def config_hash(config: Dict[str, Any]) -> str:
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class SegmentationStore:
+    def __init__(self, directory: str, config: Dict[str, Any]):
+        self.config = config
+        self.config_hash = config_hash(config)
+        self.directory = os.path.join(directory, self.config_hash)
+        self.manifest_path = os.path.join(self.directory, "manifest.jsonl")
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(self.directory, "shards"), exist_ok=True)
+
+        config_path = os.path.join(self.directory, "config.json")
+        if not os.path.isfile(config_path):
+            with open(config_path, "w") as f:
+                json.dump(config, f, indent=2, sort_keys=True, default=str)
+        self.entries = self._read_manifest()
+
+    def _read_manifest(self) -> Dict[str, Dict[str, Any]]:
+        entries = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a crash can leave the last line half written
+                        continue
+                    entries[entry["image"]] = entry
+        return entries
+
+    def shard_path(self, image: str) -> str:
+        return os.path.join(self.directory, "shards", hashlib.sha1(image.encode()).hexdigest()[:20] + ".npz")
+
+    def __contains__(self, image: str) -> bool:
+        return image in self.entries and os.path.isfile(self.shard_path(image))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def put(self, image: str, masks: CompactMasks, prompt: Optional[Dict[str, Any]] = None, **extra: Any) -> None:
+        path = self.shard_path(image)
+        tmp_path = path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, prompt=np.array(json.dumps(prompt, default=str)), **masks.to_arrays())
+        # the shard is complete before the manifest points at it
+        os.replace(tmp_path, path)
+
+        entry = {
+            "image": image,
+            "shard": os.path.basename(path),
+            "masks": len(masks),
+            "bytes": os.path.getsize(path),
+            "created": time.time(),
+            **extra
+        }
+        with self.lock:
+            with open(self.manifest_path, "a") as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+            self.entries[image] = entry
+
+    def get(self, image: str) -> CompactMasks:
+        with np.load(self.shard_path(image)) as arrays:
+            return CompactMasks.from_arrays(arrays)
+
+    def prompt(self, image: str) -> Optional[Dict[str, Any]]:
+        with np.load(self.shard_path(image)) as arrays:
+            return json.loads(str(arrays["prompt"]))
+
+    def keys(self) -> List[str]:
+        return list(self.entries)
+
+    def items(self) -> Iterator[Tuple[str, CompactMasks]]:
+        for image in self.keys():
+            yield image, self.get(image)
+
+    def manifest(self) -> pd.DataFrame:
+        return pd.DataFrame(list(self.entries.values()))
+
+
+def generation_config(profile_name: str) -> Dict[str, Any]:
+    profile = SAM_PROFILES[profile_name]
+    return {"task": "automatic", "model": sam_model_key(profile.model_type), "profile": asdict(profile)}
+
+
+result_store = SegmentationStore(SEGMENTATION_STORE_DIR, generation_config(SAM_PROFILE))
+result_store.put(IMAGE_PATH, compact_masks, prompt={"mode": "automatic"})
+result_store.manifest()
+
 """### Results visualisation with Supervision
 
-As of version `0.5.0` Supervision has native support for SAM.
+As of version `0.5.0` Supervision has native support for SAM. `CompactMasks.to_detections` gives the same `sv.Detections` as `sv.Detections.from_sam`.
 """
 
 mask_annotator = sv.MaskAnnotator()
 
-detections = sv.Detections.from_sam(sam_result=sam_result)
+with profiler.stage("detections", IMAGE_PATH) as record:
+    detections = compact_masks.to_detections()
+    record["masks"] = len(detections)
 
-annotated_image = mask_annotator.annotate(scene=image_bgr.copy(), detections=detections)
+with profiler.stage("annotate", IMAGE_PATH):
+    annotated_image = mask_annotator.annotate(scene=image_bgr.copy(), detections=detections)
 
 sv.plot_images_grid(
     images=[image_bgr, annotated_image],
@@ -176,10 +1234,11 @@ sv.plot_images_grid(
 
 """### Interaction with segmentation results"""
 
+# `compact_masks` is already sorted by area, masks are decoded one by one
 masks = [
-    mask['segmentation']
-    for mask
-    in sorted(sam_result, key=lambda x: x['area'], reverse=True)
+    compact_masks.mask(index)
+    for index
+    in range(len(compact_masks))
 ]
 
 sv.plot_images_grid(
@@ -194,12 +1253,159 @@ x = len(masks)
 print(x)
 print(int(x/8))
 
+"""### Benchmark Throughput Profiles
+
+Runs every profile over a folder of PD scans and reports masks/sec, seconds/image, peak memory (RSS sampled in the background, plus CUDA allocator peak) and the agreement with the `vit_h` baseline - for every baseline mask the best IoU among the profile's masks, averaged over the folder. Masks are compared on a 4x subsampled grid to keep the IoU matrices small. The embedding cache is bypassed so that every profile pays for its own image encoder. Every profile builds its backbone and runs automatic generation over the folder, which can take hours on CPU, so the benchmarks in this notebook only run with `RUN_BENCHMARKS = True`.
+"""
+
+import threading
+import time
+from typing import List
+
+import pandas as pd
+
+PD_DATASET_DIRECTORY = '/content/drive/My Drive/PD Dataset'
+RUN_BENCHMARKS = False
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+def list_images(directory: str) -> List[str]:
+    return sorted(
+        os.path.join(directory, file_name)
+        for file_name
+        in os.listdir(directory)
+        if file_name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def mask_iou_matrix(masks_a: np.ndarray, masks_b: np.ndarray) -> np.ndarray:
+    a = masks_a.reshape(len(masks_a), -1).astype(np.float32)
+    b = masks_b.reshape(len(masks_b), -1).astype(np.float32)
+    intersection = a @ b.T
+    union = a.sum(axis=1)[:, None] + b.sum(axis=1)[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def mask_agreement(baseline_masks: np.ndarray, masks: np.ndarray) -> float:
+    if len(baseline_masks) == 0 or len(masks) == 0:
+        return float(len(baseline_masks) == len(masks))
+    return float(mask_iou_matrix(baseline_masks, masks).max(axis=1).mean())
+
+
+def benchmark_profiles(image_directory: str, profiles=("accurate", "balanced", "fast"), baseline: str = "accurate", limit: Optional[int] = None, stride: int = 4) -> pd.DataFrame:
+    images = [
+        image_store.rgb(path)
+        for path
+        in list_images(image_directory)[:limit]
+    ]
+    # the baseline has to run first, the other profiles are compared against it
+    profiles = [baseline] + [profile for profile in profiles if profile != baseline]
+    baseline_masks = []
+    rows = []
+
+    for profile_name in profiles:
+        generator = build_mask_generator(profile_name, cache=None)
+        agreements, mask_count, seconds = [], 0, 0.0
+
+        with PeakMemorySampler() as memory:
+            for index, image in enumerate(images):
+                start = time.perf_counter()
+                result = generator.generate(image)
+                seconds += time.perf_counter() - start
+                mask_count += len(result)
+
+                masks = np.zeros((len(result),) + image[::stride, ::stride].shape[:2], dtype=bool)
+                for i, mask in enumerate(result):
+                    masks[i] = mask['segmentation'][::stride, ::stride]
+
+                if profile_name == baseline:
+                    baseline_masks.append(masks)
+                agreements.append(mask_agreement(baseline_masks[index], masks))
+
+        rows.append({
+            "profile": profile_name,
+            "model_type": SAM_PROFILES[profile_name].model_type,
+            "images": len(images),
+            "masks/sec": mask_count / seconds if seconds else 0.0,
+            "sec/image": seconds / len(images) if images else 0.0,
+            "peak_rss_mb": memory.peak_rss_mb,
+            "peak_cuda_mb": memory.peak_cuda_mb,
+            f"agreement_{SAM_PROFILES[baseline].model_type}": float(np.mean(agreements)) if agreements else 0.0,
+        })
+
+    return pd.DataFrame(rows)
+
+
+if RUN_BENCHMARKS:
+    print(benchmark_profiles(PD_DATASET_DIRECTORY, limit=10))
+
+"""### Int8 Quantization Report
+
+Compares the int8 image encoder (`QUANTIZE_CPU`) with fp32 on a folder of PD scans, using automatic mask generation with the current profile's settings. For every fp32 mask we take the best matching int8 mask and report the mean IoU and the mean absolute `predicted_iou` drift between the two. Latency is reported both for the image encoder alone (`set_image`) and for the whole `generate` call, together with the peak memory of each run. CPU only, and like the other benchmarks it only runs with `RUN_BENCHMARKS = True`.
+"""
+
+
+def quantization_report(image_directory: str, model_type: str = MODEL_TYPE, profile_name: str = SAM_PROFILE, limit: Optional[int] = 10, stride: int = 4) -> pd.DataFrame:
+    images = [
+        image_store.rgb(path)
+        for path
+        in list_images(image_directory)[:limit]
+    ]
+    outputs = {}
+    rows = []
+
+    for quantize in (False, True):
+        generator = SamAutomaticMaskGenerator(load_sam(model_type, quantize=quantize), **SAM_PROFILES[profile_name].generator_kwargs())
+        encode_seconds, generate_seconds, outputs[quantize] = 0.0, 0.0, []
+
+        with PeakMemorySampler() as memory:
+            for image in images:
+                start = time.perf_counter()
+                generator.predictor.set_image(image)
+                encode_seconds += time.perf_counter() - start
+
+                start = time.perf_counter()
+                result = generator.generate(image)
+                generate_seconds += time.perf_counter() - start
+
+                masks = np.zeros((len(result),) + image[::stride, ::stride].shape[:2], dtype=bool)
+                for i, mask in enumerate(result):
+                    masks[i] = mask['segmentation'][::stride, ::stride]
+                outputs[quantize].append((masks, np.array([mask['predicted_iou'] for mask in result])))
+
+        rows.append({
+            "model": sam_model_key(model_type, quantize),
+            "encoder_sec/image": encode_seconds / len(images),
+            "generate_sec/image": generate_seconds / len(images),
+            "masks/image": sum(len(masks) for masks, _ in outputs[quantize]) / len(images),
+            "peak_rss_mb": memory.peak_rss_mb,
+        })
+
+    ious, drifts = [], []
+    for (fp32_masks, fp32_scores), (int8_masks, int8_scores) in zip(outputs[False], outputs[True]):
+        if len(fp32_masks) == 0 or len(int8_masks) == 0:
+            continue
+        iou = mask_iou_matrix(fp32_masks, int8_masks)
+        best = iou.argmax(axis=1)
+        ious.append(iou.max(axis=1))
+        drifts.append(np.abs(int8_scores[best] - fp32_scores))
+
+    report = pd.DataFrame(rows)
+    report["mean_iou_vs_fp32"] = [1.0, float(np.concatenate(ious).mean()) if ious else float("nan")]
+    report["predicted_iou_drift"] = [0.0, float(np.concatenate(drifts).mean()) if drifts else float("nan")]
+    return report
+
+
+# 2x the automatic generations of the folder, and only meaningful on CPU
+if RUN_BENCHMARKS and DEVICE.type == "cpu":
+    print(quantization_report(PD_DATASET_DIRECTORY))
+
 """## Generate Segmentation with Bounding Box
 
 The `SamPredictor` class provides an easy interface to the model for prompting the model. It allows the user to first set an image using the `set_image` method, which calculates the necessary image embeddings. Then, prompts can be provided via the `predict` method to efficiently predict masks from those prompts. The model can take as input both point and box prompts, as well as masks from the previous iteration of prediction.
 """
 
-mask_predictor = SamPredictor(sam)
+mask_predictor = CachedSamPredictor(sam, sam_model_key(MODEL_TYPE), CHECKPOINT_PATH, embedding_cache)
 
 # import os
 
@@ -216,10 +1422,8 @@ mask_predictor = SamPredictor(sam)
 import base64
 
 def encode_image(filepath):
-    with open(filepath, 'rb') as f:
-        image_bytes = f.read()
-    encoded = str(base64.b64encode(image_bytes), 'utf-8')
-    return "data:image/jpg;base64,"+encoded
+    # the bytes were already read when the image was decoded
+    return image_store.data_uri(filepath)
 
 """**NOTE:** Execute cell below and use your mouse to draw bounding box on the image 👇"""
 
@@ -259,18 +1463,25 @@ import cv2
 import numpy as np
 import supervision as sv
 
-image_bgr = cv2.imread(IMAGE_PATH)
-image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+with profiler.stage("decode", IMAGE_PATH):
+    image = image_store.get(IMAGE_PATH)
+image_bgr, image_rgb = image.bgr, image.rgb
 
-mask_predictor.set_image(image_rgb)
+with profiler.stage("set_image", IMAGE_PATH):
+    mask_predictor.set_image(image_rgb)
 
-masks, scores, logits = mask_predictor.predict(
-    box=box,
-    multimask_output=True
-)
+with profiler.stage("predict", IMAGE_PATH) as record:
+    masks, scores, logits = mask_predictor.predict(
+        box=box,
+        multimask_output=True
+    )
+    record["masks"] = len(masks)
 
 # print(mask_predictor)
 
+# the embedding was computed by `mask_generator.generate` above, so this is a cache hit
+print("embedding cache hits:", mask_predictor.hits, "misses:", mask_predictor.misses)
+
 print(masks)
 
 print(masks.shape)
@@ -288,15 +1499,17 @@ print(logits)
 box_annotator = sv.BoxAnnotator(color=sv.Color.red())
 mask_annotator = sv.MaskAnnotator(color=sv.Color.red())
 
-detections = sv.Detections(
-    xyxy=sv.mask_to_xyxy(masks=masks),
-    mask=masks
-)
+with profiler.stage("detections", IMAGE_PATH):
+    detections = sv.Detections(
+        xyxy=sv.mask_to_xyxy(masks=masks),
+        mask=masks
+    )
 # print(detections)
 detections = detections[detections.area == np.max(detections.area)]
 
-source_image = box_annotator.annotate(scene=image_bgr.copy(), detections=detections, skip_label=True)
-segmented_image = mask_annotator.annotate(scene=image_bgr.copy(), detections=detections)
+with profiler.stage("annotate", IMAGE_PATH):
+    source_image = box_annotator.annotate(scene=image_bgr.copy(), detections=detections, skip_label=True)
+    segmented_image = mask_annotator.annotate(scene=image_bgr.copy(), detections=detections)
 
 sv.plot_images_grid(
     images=[source_image, segmented_image],
@@ -313,20 +1526,129 @@ print(source_image)
 
 print(segmented_image)
 
-'''
-FINDING IF SOURCE AND SEGMENTED IMAGE ARE SAME--->THEY ARE DIFFERENT
-
-for i in range(segmented_image.shape[0]):
-  for j in range(segmented_image.shape[1]):
-    for k in range(segmented_image.shape[2]):
-      if segmented_image[i,j,k]!=source_image[i,j,k]:
-        print("Different co-ordinates at ",i,j,k)
-
-'''
+# FINDING IF SOURCE AND SEGMENTED IMAGE ARE SAME--->THEY ARE DIFFERENT
+different = np.argwhere(segmented_image != source_image)
+print("Different co-ordinates:", len(different))
+print(different[:10])
 
 print(detections.area)
 print(detections.box_area) # (x,y,w,h) ===> (w-x)*(h-y) ====> (380-269)*(529-344) = 20535
 
+"""### Segmentation QA
+
+Whole-array version of the pixel by pixel comparison above, usable on every image of a run. `segmentation_qa` does two separate checks:
+
+* **overlap** - the SAM mask against a region SAM did not produce: the prompt box (`xyxy`) or a ground truth mask. For a box the `iou` is between the tight box of the mask and the prompt box, for a mask it is the mask IoU. `inside` is the fraction of the SAM mask within the reference, `coverage` the fraction of the reference covered by the SAM mask.
+* **rendering** - the changed pixels between the source image and the image with the SAM mask painted on it should be the mask itself (`render_iou`), with the per-channel deltas inside the changed region.
+
+`SegmentationQAReport` collects one row per image and writes a per-dataset summary table; rows with an empty mask or a low overlap are `flagged`, rows whose painted image does not match the mask are `render_flagged`.
+"""
+
+from typing import Any, Dict, List
+
+import pandas as pd
+
+QA_DIRECTORY = os.path.join(HOME, "qa")
+
+
+def _mask_box(mask: np.ndarray) -> Optional[np.ndarray]:
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return None
+    # exclusive max, like the prompt boxes
+    return np.array([cols[0], rows[0], cols[-1] + 1, rows[-1] + 1])
+
+
+def _box_iou(box_a: np.ndarray, box_b: np.ndarray) -> float:
+    width = max(0.0, min(box_a[2], box_b[2]) - max(box_a[0], box_b[0]))
+    height = max(0.0, min(box_a[3], box_b[3]) - max(box_a[1], box_b[1]))
+    intersection = width * height
+    union = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1]) + (box_b[2] - box_b[0]) * (box_b[3] - box_b[1]) - intersection
+    return float(intersection / union) if union > 0 else 0.0
+
+
+def segmentation_qa(source_image: np.ndarray, segmented_image: np.ndarray, sam_mask: np.ndarray, reference: np.ndarray) -> Dict[str, Any]:
+    reference = np.asarray(reference)
+    mask_area = int(np.count_nonzero(sam_mask))
+
+    # overlap with the independent reference - a prompt box or a ground truth mask
+    if reference.shape == (4,):
+        x_min, y_min, x_max, y_max = np.round(reference).astype(int)
+        region = np.zeros(sam_mask.shape, dtype=bool)
+        region[max(y_min, 0):max(y_max, 0), max(x_min, 0):max(x_max, 0)] = True
+        mask_box = _mask_box(sam_mask)
+        iou = _box_iou(mask_box, reference) if mask_box is not None else 0.0
+    else:
+        region = reference.astype(bool)
+        iou = None
+    region_area = int(np.count_nonzero(region))
+    intersection = int(np.count_nonzero(region & sam_mask))
+    if iou is None:
+        union = region_area + mask_area - intersection
+        iou = intersection / union if union else 1.0
+
+    # rendering - the painted pixels should be exactly the mask
+    changed = np.any(source_image != segmented_image, axis=-1)
+    changed_area = int(np.count_nonzero(changed))
+    rendered = int(np.count_nonzero(changed & sam_mask))
+    rendered_union = changed_area + mask_area - rendered
+
+    row = {
+        "height": source_image.shape[0],
+        "width": source_image.shape[1],
+        "reference": "box" if reference.shape == (4,) else "mask",
+        "mask_area": mask_area,
+        "reference_area": region_area,
+        "iou": iou,
+        "inside": intersection / mask_area if mask_area else 0.0,
+        "coverage": intersection / region_area if region_area else 0.0,
+        "changed_area": changed_area,
+        "changed_fraction": changed_area / changed.size,
+        "render_iou": rendered / rendered_union if rendered_union else 1.0,
+    }
+
+    # only changed pixels are gathered, so the int16 copy is as small as the annotated region
+    delta = segmented_image[changed].astype(np.int16) - source_image[changed].astype(np.int16)
+    for channel, name in enumerate("bgr"):
+        row[f"mean_delta_{name}"] = float(delta[:, channel].mean()) if changed_area else 0.0
+        row[f"max_abs_delta_{name}"] = int(np.abs(delta[:, channel]).max()) if changed_area else 0
+
+    return row
+
+
+class SegmentationQAReport:
+    def __init__(self, min_iou: float = 0.5, min_render_iou: float = 0.95):
+        self.min_iou = min_iou
+        self.min_render_iou = min_render_iou
+        self.rows: List[Dict[str, Any]] = []
+
+    def add(self, image_name: str, source_image: np.ndarray, segmented_image: np.ndarray, sam_mask: np.ndarray, reference: np.ndarray) -> Dict[str, Any]:
+        row = {"image": image_name, **segmentation_qa(source_image, segmented_image, sam_mask, reference)}
+        row["flagged"] = row["mask_area"] == 0 or row["iou"] < self.min_iou
+        row["render_flagged"] = row["render_iou"] < self.min_render_iou
+        self.rows.append(row)
+        return row
+
+    def table(self) -> pd.DataFrame:
+        return pd.DataFrame(self.rows)
+
+    def summary(self) -> pd.DataFrame:
+        table = self.table()
+        return table.drop(columns=["image", "reference"]).describe().T
+
+    def save(self, directory: str = QA_DIRECTORY, name: str = "qa") -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}.csv")
+        self.table().to_csv(path, index=False)
+        self.summary().to_csv(os.path.join(directory, f"{name}_summary.csv"))
+        return path
+
+
+# the mask is checked against the prompt box it was generated from
+qa_report = SegmentationQAReport()
+qa_report.add(IMAGE_PATH, image_bgr, segmented_image, detections.mask.any(axis=0), box)
+qa_report.table()
+
 """### Interaction with segmentation results"""
 
 import supervision as v
@@ -337,6 +1659,203 @@ sv.plot_images_grid(
     size=(16, 4)
 )
 
+"""### Region of Interest Mode
+
+On PD scans only the region inside the box matters, but `mask_generator.generate` samples its point grid over the whole frame and post-processes (upscaling, stability filtering, NMS) every mask at full resolution. `generate_in_roi` crops the image to the box plus a `margin`, runs automatic generation on the crop only and maps the results back to full-image coordinates - `segmentation`, `bbox`, `point_coords` and `crop_box` - so the output is a drop-in replacement for `sam_result`.
+
+**NOTE:** SAM resizes every input to 1024 px on the long side, so the image encoder costs the same for a crop; the gain is in post-processing, and the whole point grid now lands inside the region, at a higher effective resolution.
+
+`benchmark_roi` times full-frame and ROI generation side by side (`repeats` times each) and reports the agreement between them. It runs automatic generation twice per repeat, so like the other benchmarks it only runs with `RUN_BENCHMARKS = True`.
+"""
+
+from typing import Any, Dict, List, Tuple
+
+import torch
+from segment_anything.utils.amg import mask_to_rle_pytorch, rle_to_mask
+
+
+def roi_bounds(image_shape: Tuple[int, ...], box: np.ndarray, margin: float = 0.1) -> Tuple[int, int, int, int]:
+    height, width = image_shape[:2]
+    x_min, y_min, x_max, y_max = np.asarray(box, dtype=float)
+    pad_x, pad_y = (x_max - x_min) * margin, (y_max - y_min) * margin
+    return (
+        int(max(0, np.floor(x_min - pad_x))),
+        int(max(0, np.floor(y_min - pad_y))),
+        int(min(width, np.ceil(x_max + pad_x))),
+        int(min(height, np.ceil(y_max + pad_y)))
+    )
+
+
+def generate_in_roi(mask_generator: SamAutomaticMaskGenerator, image_rgb: np.ndarray, box: np.ndarray, margin: float = 0.1) -> List[Dict[str, Any]]:
+    x_min, y_min, x_max, y_max = roi_bounds(image_rgb.shape, box, margin)
+    height, width = image_rgb.shape[:2]
+    crop = np.ascontiguousarray(image_rgb[y_min:y_max, x_min:x_max])
+
+    sam_result = mask_generator.generate(crop)
+    for mask in sam_result:
+        segmentation = mask['segmentation']
+        is_rle = isinstance(segmentation, dict)
+        full = np.zeros((height, width), dtype=bool)
+        full[y_min:y_max, x_min:x_max] = rle_to_mask(segmentation) if is_rle else segmentation
+        mask['segmentation'] = mask_to_rle_pytorch(torch.from_numpy(full)[None])[0] if is_rle else full
+
+        x, y, w, h = mask['bbox']
+        mask['bbox'] = [x + x_min, y + y_min, w, h]
+        mask['point_coords'] = [[px + x_min, py + y_min] for px, py in mask['point_coords']]
+        x, y, w, h = mask['crop_box']
+        mask['crop_box'] = [x + x_min, y + y_min, w, h]
+    return sam_result
+
+
+def benchmark_roi(profile_name: str, items: List[Tuple[str, np.ndarray, np.ndarray]], margin: float = 0.1, repeats: int = 3) -> pd.DataFrame:
+    # no embedding cache - every run has to pay for its own encoder pass
+    generator = build_mask_generator(profile_name, cache=None)
+    rows = []
+    for name, image_rgb, box in items:
+        x_min, y_min, x_max, y_max = roi_bounds(image_rgb.shape, box, margin)
+        timings = {"full": [], "roi": []}
+        for _ in range(repeats):
+            start = time.perf_counter()
+            full_result = generator.generate(image_rgb)
+            timings["full"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            roi_result = generate_in_roi(generator, image_rgb, box, margin)
+            timings["roi"].append(time.perf_counter() - start)
+
+        # the full frame masks that fall inside the region are the ones the ROI mode should find
+        full_masks = CompactMasks.from_sam_result(full_result, shape=image_rgb.shape[:2])
+        inside = (full_masks.xyxy[:, 0] >= x_min) & (full_masks.xyxy[:, 1] >= y_min) & (full_masks.xyxy[:, 2] < x_max) & (full_masks.xyxy[:, 3] < y_max)
+        roi_masks = CompactMasks.from_sam_result(roi_result, shape=image_rgb.shape[:2])
+        full_seconds, roi_seconds = np.median(timings["full"]), np.median(timings["roi"])
+        rows.append({
+            "image": name,
+            "roi_fraction": (x_max - x_min) * (y_max - y_min) / (image_rgb.shape[0] * image_rgb.shape[1]),
+            "full_s": full_seconds,
+            "roi_s": roi_seconds,
+            "speedup": full_seconds / roi_seconds,
+            "full_masks_in_roi": int(inside.sum()),
+            "roi_masks": len(roi_masks),
+            "agreement": mask_agreement(full_masks[np.flatnonzero(inside)].decode(), roi_masks.decode()),
+        })
+    return pd.DataFrame(rows)
+
+
+roi_result = generate_in_roi(mask_generator, image_rgb, box)
+print(len(roi_result), "masks inside", roi_bounds(image_rgb.shape, box))
+
+if RUN_BENCHMARKS:
+    print(benchmark_roi(SAM_PROFILE, [(IMAGE_PATH, image_rgb, box)]))
+
+"""### Volume Mode
+
+DaTscan / MRI studies come as stacks of slices, and prompting every slice by hand (or running automatic generation on each) doesn't scale. `propagate_volume` takes one prompt on a seed slice and walks the stack in both directions: each next slice is prompted with the previous slice's low-resolution `logits` as `mask_input` together with a box derived from the previous mask (plus `box_margin`). Propagation in a direction stops when the mask vanishes (`min_area`) or the predicted IoU drops below `min_score`.
+
+The volume can be a directory of slice images (sorted by the numbers in the file names) or a 3D / 4D array. The result is a `(slices, height, width)` mask volume plus a per-slice table with the encoder and decoder time.
+"""
+
+import re
+from typing import Optional, Tuple, Union
+
+VOLUME_DIRECTORY = os.path.join(PD_DATASET_DIRECTORY, "Volume")
+
+
+def _natural_key(path: str) -> list:
+    return [int(token) if token.isdigit() else token for token in re.split(r"(\d+)", os.path.basename(path))]
+
+
+def load_slices(source: Union[str, np.ndarray]) -> np.ndarray:
+    if isinstance(source, str):
+        return np.stack([image_store.rgb(path) for path in sorted(list_images(source), key=_natural_key)])
+
+    volume = np.asarray(source)
+    if volume.dtype != np.uint8:
+        # scanner intensities, scaled over the whole volume so slices stay comparable
+        low, high = float(volume.min()), float(volume.max())
+        volume = ((volume - low) / (high - low or 1.0) * 255).astype(np.uint8)
+    if volume.ndim == 3:
+        volume = np.repeat(volume[..., None], 3, axis=3)
+    return volume
+
+
+def mask_box(mask: np.ndarray, margin: float = 0.05) -> Optional[np.ndarray]:
+    ys, xs = np.nonzero(mask)
+    if len(xs) == 0:
+        return None
+    height, width = mask.shape
+    pad_x, pad_y = (xs.max() - xs.min() + 1) * margin, (ys.max() - ys.min() + 1) * margin
+    return np.array([
+        max(0, xs.min() - pad_x),
+        max(0, ys.min() - pad_y),
+        min(width - 1, xs.max() + pad_x),
+        min(height - 1, ys.max() + pad_y)
+    ])
+
+
+def propagate_volume(
+    predictor: SamPredictor,
+    volume: np.ndarray,
+    seed_index: int,
+    box: Optional[np.ndarray] = None,
+    point_coords: Optional[np.ndarray] = None,
+    point_labels: Optional[np.ndarray] = None,
+    box_margin: float = 0.05,
+    min_area: int = 16,
+    min_score: float = 0.5
+) -> Tuple[np.ndarray, pd.DataFrame]:
+    masks = np.zeros(volume.shape[:3], dtype=bool)
+    rows = []
+
+    def segment(index: int, direction: str, **prompt) -> Tuple[np.ndarray, float, np.ndarray]:
+        start = time.perf_counter()
+        predictor.set_image(volume[index])
+        encoded = time.perf_counter()
+        slice_masks, slice_scores, slice_logits = predictor.predict(multimask_output=direction == "seed", **prompt)
+        # the seed prompt is ambiguous, keep the best of the 3 candidates there
+        best = int(np.argmax(slice_scores))
+        rows.append({
+            "slice": index,
+            "direction": direction,
+            "score": float(slice_scores[best]),
+            "area": int(slice_masks[best].sum()),
+            "encode_s": encoded - start,
+            "decode_s": time.perf_counter() - encoded,
+            "stopped": False,
+        })
+        return slice_masks[best], float(slice_scores[best]), slice_logits[best][None]
+
+    seed_mask, _, seed_logits = segment(seed_index, "seed", box=box, point_coords=point_coords, point_labels=point_labels)
+    masks[seed_index] = seed_mask
+
+    for step, direction in ((1, "up"), (-1, "down")):
+        previous_mask, previous_logits = seed_mask, seed_logits
+        for index in range(seed_index + step, len(volume) if step > 0 else -1, step):
+            previous_box = mask_box(previous_mask, box_margin)
+            if previous_box is None:
+                break
+            mask, score, logits = segment(index, direction, box=previous_box, mask_input=previous_logits)
+            if mask.sum() < min_area or score < min_score:
+                rows[-1]["stopped"] = True
+                break
+            masks[index] = mask
+            previous_mask, previous_logits = mask, logits
+
+    report = pd.DataFrame(rows).sort_values("slice").reset_index(drop=True)
+    return masks, report
+
+
+if os.path.isdir(VOLUME_DIRECTORY):
+    volume = load_slices(VOLUME_DIRECTORY)
+    seed_index = len(volume) // 2
+    volume_masks, volume_report = propagate_volume(mask_predictor, volume, seed_index, box=box)
+
+    print(f"{volume_masks.any(axis=(1, 2)).sum()} / {len(volume)} slices segmented, {volume_report[['encode_s', 'decode_s']].sum().sum():.1f}s")
+    sv.plot_images_grid(
+        images=[volume_masks[index] for index in np.linspace(0, len(volume) - 1, 4).astype(int)],
+        grid_size=(1, 4),
+        size=(16, 4)
+    )
+    print(volume_report)
+
 """## SHAPE ANALYSIS"""
 
 pip install imantics
@@ -378,7 +1897,7 @@ from google.colab.patches import cv2_imshow
 IMAGE_PATH = "/content/drive/My Drive/PD Dataset/Mask.png"
 print(IMAGE_PATH)
 
-img = cv2.imread(IMAGE_PATH)
+img = image_store.bgr(IMAGE_PATH)
 cv2_imshow(img)
 # hh, ww = img.shape[:2]
 
@@ -414,6 +1933,1023 @@ cv2_imshow(img)
 # save results
 # cv2.imwrite('ellipse_shape_fitted.png', result)
 
+"""### Batch Shape Features
+
+The cell above fits an ellipse to one thresholded `Mask.png` at a time. `ShapeFeatureEngine` takes SAM masks directly - `sam_result`, the `masks` array returned by `mask_predictor.predict`, `sv.Detections` or `CompactMasks` - and computes for every mask:
+
+* ellipse fitted to the convex hull (centre, major / minor axis, angle) and its eccentricity
+* area, perimeter, circularity
+* convex hull area and solidity
+* the 7 Hu moments
+
+A SAM mask can have several components. All of the features above describe the same region - the outer contour of the largest component, holes filled - so circularity and solidity stay between 0 and 1. `pixel_area` and `components` describe the whole mask.
+
+Masks are shipped to a process pool as bit-packed bounding box crops (see `CompactMasks`), in chunks of `chunk_size`, and the result is one feature table for all masks. This is the quantitative signal we use for PD vs SWEDD.
+"""
+
+import math
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+import pandas as pd
+
+HU_MOMENTS = [f"hu_{i}" for i in range(1, 8)]
+
+
+def to_compact_masks(masks: Union[CompactMasks, List[Dict[str, Any]], np.ndarray, sv.Detections]) -> CompactMasks:
+    if isinstance(masks, CompactMasks):
+        return masks
+    if isinstance(masks, sv.Detections):
+        return CompactMasks.from_detections(masks)
+    if isinstance(masks, list) and (len(masks) == 0 or isinstance(masks[0], dict)):
+        return CompactMasks.from_sam_result(masks)
+    return CompactMasks.from_masks(np.asarray(masks))
+
+
+def shape_features(mask: np.ndarray, offset: Tuple[int, int] = (0, 0)) -> Dict[str, float]:
+    mask = mask.astype(np.uint8)
+    features = {
+        "pixel_area": float(np.count_nonzero(mask)),
+        "components": 0,
+        "area": math.nan,
+        "perimeter": math.nan,
+        "circularity": math.nan,
+        "hull_area": math.nan,
+        "solidity": math.nan,
+        "ellipse_cx": math.nan,
+        "ellipse_cy": math.nan,
+        "ellipse_major": math.nan,
+        "ellipse_minor": math.nan,
+        "ellipse_angle": math.nan,
+        "eccentricity": math.nan,
+    }
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    features["components"] = len(contours)
+    # every metric below describes the largest component only, otherwise the area of the
+    # other components inflates circularity and solidity
+    contour = max(contours, key=cv2.contourArea) if contours else None
+    if contour is not None:
+        hull = cv2.convexHull(contour)
+        features["area"] = cv2.contourArea(contour)
+        features["perimeter"] = cv2.arcLength(contour, True)
+        features["hull_area"] = cv2.contourArea(hull)
+        if features["perimeter"] > 0:
+            features["circularity"] = 4 * math.pi * features["area"] / features["perimeter"] ** 2
+        if features["hull_area"] > 0:
+            features["solidity"] = features["area"] / features["hull_area"]
+
+        # same as the single mask example - fit the ellipse to the convex hull
+        points = hull if len(hull) >= 5 else contour
+        if len(points) >= 5:
+            (centx, centy), (width, height), angle = cv2.fitEllipse(points)
+            major, minor = max(width, height), min(width, height)
+            features["ellipse_cx"] = centx + offset[0]
+            features["ellipse_cy"] = centy + offset[1]
+            features["ellipse_major"] = major
+            features["ellipse_minor"] = minor
+            features["ellipse_angle"] = angle
+            features["eccentricity"] = math.sqrt(1 - (minor / major) ** 2) if major > 0 else math.nan
+
+    hu = cv2.HuMoments(cv2.moments(contour)).ravel() if contour is not None else np.full(7, math.nan)
+    features.update(zip(HU_MOMENTS, hu.tolist()))
+    return features
+
+
+def _shape_features_chunk(chunk: List[Tuple[str, int, np.ndarray, np.ndarray]]) -> List[Dict[str, Any]]:
+    rows = []
+    for image_name, mask_index, packed, box in chunk:
+        x_min, y_min, x_max, y_max = box
+        height, width = y_max - y_min + 1, x_max - x_min + 1
+        crop = np.unpackbits(packed, count=height * width).reshape(height, width)
+        rows.append({"image": image_name, "mask_index": mask_index, **shape_features(crop, offset=(x_min, y_min))})
+    return rows
+
+
+def _timed_shape_features_chunk(chunk: List[Tuple[str, int, np.ndarray, np.ndarray]]) -> Tuple[List[Dict[str, Any]], float]:
+    start = time.perf_counter()
+    rows = _shape_features_chunk(chunk)
+    return rows, time.perf_counter() - start
+
+
+class ShapeFeatureEngine:
+    def __init__(self, max_workers: Optional[int] = None, chunk_size: int = 64):
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.chunk_size = chunk_size
+        self._executor = None
+
+    def __enter__(self) -> "ShapeFeatureEngine":
+        if self.max_workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("fork"))
+            # fork the workers now, before callers start any threads of their own
+            self._executor.submit(int).result()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _chunks(self, named_masks: Iterable[Tuple[str, Any]]) -> Iterator[List[Tuple[str, int, np.ndarray, np.ndarray]]]:
+        chunk = []
+        for image_name, masks in named_masks:
+            compact = to_compact_masks(masks)
+            for index in range(len(compact)):
+                chunk.append((image_name, index, compact.packed[index], compact.xyxy[index]))
+                if len(chunk) == self.chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def submit(self, image_name: str, masks: Any) -> Future:
+        compact = to_compact_masks(masks)
+        chunk = [(image_name, index, compact.packed[index], compact.xyxy[index]) for index in range(len(compact))]
+        if self._executor is None:
+            future = Future()
+            future.set_result(_timed_shape_features_chunk(chunk))
+            return future
+        return self._executor.submit(_timed_shape_features_chunk, chunk)
+
+    def extract(self, named_masks: Iterable[Tuple[str, Any]]) -> pd.DataFrame:
+        chunks = self._chunks(named_masks)
+        if self._executor is None:
+            results = map(_shape_features_chunk, chunks)
+        else:
+            results = self._executor.map(_shape_features_chunk, chunks)
+        return pd.DataFrame([row for rows in results for row in rows])
+
+
+with ShapeFeatureEngine() as shape_engine:
+    shape_table = shape_engine.extract([
+        ("automatic", sam_result),
+        ("box", masks),
+    ])
+
+shape_table.head()
+
+"""### Mask to Polygon
+
+`imantics.Mask(array).polygons()` handles one full size mask at a time and is slow on 1000x1000 scans. `masks_to_polygons` takes a whole stack (anything `to_compact_masks` accepts) and traces the contours of every mask on its bounding box crop only. Like imantics, holes are kept: every outer polygon is followed by the polygons of its holes. `epsilon` enables Douglas-Peucker simplification (in pixels) and `max_vertices` (at least 3) caps the vertex count of every polygon by increasing `epsilon` until it fits. Parts that are one pixel wide trace to fewer than 3 vertices and are padded to a degenerate triangle instead of being dropped; `min_area` drops polygons smaller than that many pixels. The output of each mask is a `COCOAnnotation.segmentation` - a list of flat `[x1, y1, x2, y2, ...]` polygons.
+"""
+
+
+def _limit_vertices(contour: np.ndarray, max_vertices: int, epsilon: float) -> np.ndarray:
+    low, high = epsilon, max(epsilon, 1.0)
+    # grow epsilon until the polygon fits, then binary search the smallest one that does
+    while len(cv2.approxPolyDP(contour, high, True)) > max_vertices:
+        low, high = high, high * 2
+    for _ in range(10):
+        middle = (low + high) / 2
+        if len(cv2.approxPolyDP(contour, middle, True)) > max_vertices:
+            low = middle
+        else:
+            high = middle
+    return cv2.approxPolyDP(contour, high, True)
+
+
+def _outer_then_holes(hierarchy: np.ndarray) -> Iterator[int]:
+    # RETR_CCOMP has two levels - outer contours and their holes, linked by [next, previous, first child, parent]
+    for index, (_, _, child, parent) in enumerate(hierarchy):
+        if parent != -1:
+            continue
+        yield index
+        while child != -1:
+            yield child
+            child = hierarchy[child][0]
+
+
+def masks_to_polygons(masks: Any, epsilon: float = 0.0, max_vertices: Optional[int] = None, min_area: float = 0.0) -> List[List[List[float]]]:
+    if max_vertices is not None and max_vertices < 3:
+        raise ValueError(f"max_vertices must be at least 3, got {max_vertices}")
+
+    compact = to_compact_masks(masks)
+    segmentations = []
+
+    for index in range(len(compact)):
+        crop, offset = compact.crop(index)
+        contours, hierarchy = cv2.findContours(crop.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+
+        polygons = []
+        for contour_index in (_outer_then_holes(hierarchy[0]) if contours else ()):
+            contour = contours[contour_index]
+            if epsilon > 0:
+                contour = cv2.approxPolyDP(contour, epsilon, True)
+            if max_vertices is not None and len(contour) > max_vertices:
+                contour = _limit_vertices(contour, max_vertices, epsilon)
+            if min_area > 0 and cv2.contourArea(contour) < min_area:
+                continue
+            # a one pixel wide part traces to 1 or 2 vertices, repeat them into a valid polygon
+            if len(contour) < 3:
+                contour = np.resize(contour, (3, 1, 2))
+            polygons.append(contour.reshape(-1).astype(float).tolist())
+
+        segmentations.append(polygons)
+
+    return segmentations
+
+
+segmentations = masks_to_polygons(compact_masks, epsilon=1.0, max_vertices=200)
+print(len(segmentations), sum(len(polygon) // 2 for polygons in segmentations for polygon in polygons))
+
+"""### Benchmark Mask to Polygon against imantics"""
+
+import time
+
+
+def benchmark_polygons(masks: np.ndarray, epsilon: float = 0.0) -> pd.DataFrame:
+    rows = []
+
+    start = time.perf_counter()
+    imantics_polygons = [Mask(mask).polygons().segmentation for mask in masks]
+    seconds = time.perf_counter() - start
+    rows.append({
+        "method": "imantics",
+        "masks": len(masks),
+        "ms/mask": 1000 * seconds / max(len(masks), 1),
+        "vertices": sum(len(polygon) // 2 for polygons in imantics_polygons for polygon in polygons),
+    })
+
+    start = time.perf_counter()
+    segmentations = masks_to_polygons(masks, epsilon=epsilon)
+    seconds = time.perf_counter() - start
+    rows.append({
+        "method": "masks_to_polygons",
+        "masks": len(masks),
+        "ms/mask": 1000 * seconds / max(len(masks), 1),
+        "vertices": sum(len(polygon) // 2 for polygons in segmentations for polygon in polygons),
+    })
+
+    return pd.DataFrame(rows)
+
+
+benchmark_polygons(compact_masks.decode())
+
+"""## Segment the Whole PD Dataset Directory
+
+A headless pipeline for a whole directory of scans. The stages are connected with bounded queues, so a slow stage pushes back on the ones before it instead of piling up decoded images:
+
+1. **read** - a thread pool decodes images and converts them to RGB
+2. **inference** - a single model worker runs `mask_generator.generate`, so GPU / CPU inference overlaps with disk I/O; the masks are packed into `CompactMasks` straight away, so dense masks never wait in a queue
+3. **post** - shape features are computed in the `ShapeFeatureEngine` process pool
+
+`run` yields one `PipelineResult` per image as soon as it is done - images already in the `store` are not segmented again but yielded from it (`resumed=True`), with their shape features - and `report()` shows for every stage the busy time, the time spent blocked on a full downstream queue, the time starved by an empty upstream queue and the utilisation.
+"""
+
+import itertools
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+_END_OF_STREAM = object()
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    busy_seconds: float = 0.0
+    blocked_seconds: float = 0.0
+    starved_seconds: float = 0.0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, busy: float = 0.0, blocked: float = 0.0, starved: float = 0.0, items: int = 1) -> None:
+        with self.lock:
+            self.items += items
+            self.busy_seconds += busy
+            self.blocked_seconds += blocked
+            self.starved_seconds += starved
+
+    def utilisation(self, wall_seconds: float) -> float:
+        return self.busy_seconds / (wall_seconds * self.workers) if wall_seconds else 0.0
+
+
+@dataclass
+class PipelineResult:
+    path: str
+    masks: Optional[CompactMasks] = None
+    features: Optional[pd.DataFrame] = None
+    error: Optional[str] = None
+    resumed: bool = False
+
+
+class SegmentationPipeline:
+    def __init__(self, mask_generator: SamAutomaticMaskGenerator, reader_workers: int = 4, post_workers: Optional[int] = None, queue_size: int = 4, compute_features: bool = True, image_store: ImageStore = image_store, store: Optional[SegmentationStore] = None):
+        self.mask_generator = mask_generator
+        self.image_store = image_store
+        self.store = store
+        self.skipped = 0
+        self.reader_workers = reader_workers
+        self.post_workers = post_workers if post_workers is not None else os.cpu_count()
+        self.queue_size = queue_size
+        self.compute_features = compute_features
+        self.stats: Dict[str, StageStats] = {}
+        self.wall_seconds = 0.0
+        self._stop = threading.Event()
+
+    def _put(self, target: queue.Queue, item: Any) -> float:
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        return time.perf_counter() - start
+
+    def _get(self, source: queue.Queue) -> Tuple[Any, float]:
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1), time.perf_counter() - start
+            except queue.Empty:
+                continue
+        return _END_OF_STREAM, time.perf_counter() - start
+
+    def decode(self, path: str) -> Optional[np.ndarray]:
+        return self.image_store.rgb(path)
+
+    def _read(self, path: str, decoded: queue.Queue) -> None:
+        if self._stop.is_set():
+            return
+        start = time.perf_counter()
+        try:
+            image_rgb = self.decode(path)
+        except Exception:
+            image_rgb = None
+        busy = time.perf_counter() - start
+        blocked = self._put(decoded, (path, image_rgb))
+        self.stats["read"].add(busy=busy, blocked=blocked)
+
+    def _feed(self, paths: List[str], reader: ThreadPoolExecutor, decoded: queue.Queue) -> None:
+        # paths are handed out one reader pool's worth at a time, so a stopped run decodes
+        # at most that many images more instead of the whole directory
+        in_flight = deque()
+        for path in paths:
+            if self._stop.is_set():
+                break
+            in_flight.append(reader.submit(self._read, path, decoded))
+            if len(in_flight) >= self.reader_workers:
+                wait([in_flight.popleft()])
+        wait(in_flight)
+        self._put(decoded, _END_OF_STREAM)
+
+    def _infer(self, decoded: queue.Queue, inferred: queue.Queue) -> None:
+        while True:
+            item, starved = self._get(decoded)
+            if item is _END_OF_STREAM:
+                self._put(inferred, _END_OF_STREAM)
+                return
+
+            path, image_rgb = item
+            start = time.perf_counter()
+            if image_rgb is None:
+                result = PipelineResult(path=path, error="unreadable image")
+            else:
+                try:
+                    with profiler.stage("generate", path) as record:
+                        sam_result = self.mask_generator.generate(image_rgb)
+                        record["masks"] = len(sam_result)
+                    result = PipelineResult(path=path, masks=CompactMasks.from_sam_result(sam_result, shape=image_rgb.shape[:2]).sorted_by_area())
+                except Exception as e:
+                    result = PipelineResult(path=path, error=repr(e))
+            busy = time.perf_counter() - start
+
+            blocked = self._put(inferred, result)
+            self.stats["inference"].add(busy=busy, blocked=blocked, starved=starved)
+
+    def _collect(self, result: PipelineResult, future: Future) -> PipelineResult:
+        rows, busy = future.result()
+        result.features = pd.DataFrame(rows)
+        self.stats["post"].add(busy=busy)
+        return result
+
+    def _inferred(self, inferred: queue.Queue) -> Iterator[PipelineResult]:
+        while True:
+            result, _ = self._get(inferred)
+            if result is _END_OF_STREAM:
+                return
+            yield result
+
+    def run(self, paths: Iterable[str]) -> Iterator[PipelineResult]:
+        paths = list(paths)
+        stored = []
+        if self.store is not None:
+            # resume - images already in the store for this config are not segmented again
+            stored = [path for path in paths if path in self.store]
+            paths = [path for path in paths if path not in self.store]
+        self.skipped = len(stored)
+        self.stats = {
+            "read": StageStats("read", self.reader_workers),
+            "inference": StageStats("inference", 1),
+            "post": StageStats("post", self.post_workers),
+        }
+        self._stop.clear()
+        decoded = queue.Queue(maxsize=self.queue_size)
+        inferred = queue.Queue(maxsize=self.queue_size)
+        start = time.perf_counter()
+
+        # the post-processing pool is forked before the reader and model threads start
+        with ShapeFeatureEngine(max_workers=self.post_workers) as engine, ThreadPoolExecutor(self.reader_workers) as reader:
+            threads = [
+                threading.Thread(target=self._feed, args=(paths, reader, decoded), daemon=True),
+                threading.Thread(target=self._infer, args=(decoded, inferred), daemon=True),
+            ]
+            for thread in threads:
+                thread.start()
+
+            try:
+                pending = deque()
+                # stored images are yielded with their masks from the store, so a resumed run still covers every path
+                resumed = (PipelineResult(path=path, masks=self.store.get(path), resumed=True) for path in stored)
+                for result in itertools.chain(resumed, self._inferred(inferred)):
+                    if result.masks is not None and self.store is not None and not result.resumed:
+                        self.store.put(result.path, result.masks, prompt={"mode": "automatic"})
+                    if result.masks is None or not self.compute_features:
+                        yield result
+                        continue
+
+                    pending.append((result, engine.submit(os.path.basename(result.path), result.masks)))
+                    while pending and (pending[0][1].done() or len(pending) > self.post_workers * 2):
+                        yield self._collect(*pending.popleft())
+
+                while pending:
+                    yield self._collect(*pending.popleft())
+            finally:
+                # unblocks the stages if the caller stops iterating early
+                self._stop.set()
+                reader.shutdown(wait=False, cancel_futures=True)
+                for thread in threads:
+                    thread.join()
+                self.wall_seconds = time.perf_counter() - start
+
+    def report(self) -> pd.DataFrame:
+        return pd.DataFrame([
+            {
+                "stage": stats.name,
+                "workers": stats.workers,
+                "items": stats.items,
+                "busy_s": stats.busy_seconds,
+                "blocked_s": stats.blocked_seconds,
+                "starved_s": stats.starved_seconds,
+                "utilisation": stats.utilisation(self.wall_seconds),
+            }
+            for stats
+            in self.stats.values()
+        ])
+
+
+# attach to the warm model process when there is one
+pipeline = SegmentationPipeline(RemoteMaskGenerator(sam_server, SAM_PROFILE) if sam_server is not None else mask_generator, store=result_store)
+pipeline_results = list(pipeline.run(list_images(PD_DATASET_DIRECTORY)))
+
+print(f"{len(pipeline_results)} images in {pipeline.wall_seconds:.1f}s, {pipeline.skipped} already in {result_store.directory}")
+print([result.path for result in pipeline_results if result.error])
+pipeline.report()
+
+pipeline_features = [result.features for result in pipeline_results if result.features is not None]
+pd.concat(pipeline_features, ignore_index=True) if pipeline_features else pd.DataFrame()
+
+"""### Annotated Gallery
+
+For QA of a whole directory we don't want a matplotlib grid per scan. `GalleryRenderer` draws the mask and box overlays straight into JPEG files from a pool of worker processes, without a display. Every worker keeps one scene buffer per image size and copies each scan into it with `np.copyto`, so both annotators draw on the same buffer instead of each getting a fresh `image_bgr.copy()`. Next to every annotated image it writes a thumbnail, and `write_html` / `write_contact_sheets` build paged HTML galleries and contact-sheet JPEGs from those thumbnails.
+"""
+
+import html
+import math
+import multiprocessing
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+GALLERY_DIRECTORY = os.path.join(HOME, "gallery")
+GALLERY_COLUMNS = ["image", "masks", "file", "thumbnail", "seconds", "error"]
+
+# state of a gallery worker process
+_gallery_worker = {}
+
+
+def _init_gallery_worker(image_cache_dir: Optional[str]) -> None:
+    # one thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+    _gallery_worker["images"] = ImageStore(cache_dir=image_cache_dir, max_items=2)
+    _gallery_worker["buffers"] = {}
+    _gallery_worker["mask_annotator"] = sv.MaskAnnotator()
+    _gallery_worker["box_annotator"] = sv.BoxAnnotator(color=sv.Color.red())
+
+
+def _render_gallery_image(image_path: str, masks: CompactMasks, image_file: str, thumbnail_file: str, thumbnail_size: int, quality: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    image_bgr = _gallery_worker["images"].bgr(image_path)
+
+    buffers = _gallery_worker["buffers"]
+    if image_bgr.shape not in buffers:
+        buffers[image_bgr.shape] = np.empty(image_bgr.shape, dtype=np.uint8)
+    scene = buffers[image_bgr.shape]
+    np.copyto(scene, image_bgr)
+
+    if len(masks):
+        detections = masks.to_detections()
+        # a colour per mask, the annotators pick colours by class id
+        detections.class_id = np.arange(len(detections))
+        scene = _gallery_worker["mask_annotator"].annotate(scene=scene, detections=detections)
+        scene = _gallery_worker["box_annotator"].annotate(scene=scene, detections=detections, skip_label=True)
+
+    height, width = scene.shape[:2]
+    scale = thumbnail_size / max(height, width)
+    thumbnail = cv2.resize(scene, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    cv2.imwrite(image_file, scene, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    cv2.imwrite(thumbnail_file, thumbnail, [cv2.IMWRITE_JPEG_QUALITY, quality])
+
+    return {
+        "image": image_path,
+        "masks": len(masks),
+        "file": image_file,
+        "thumbnail": thumbnail_file,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _safe_render_gallery_image(*args: Any) -> Dict[str, Any]:
+    try:
+        return _render_gallery_image(*args)
+    except Exception as e:
+        return {"image": args[0], "error": repr(e)}
+
+
+class GalleryRenderer:
+    def __init__(self, directory: str = GALLERY_DIRECTORY, max_workers: Optional[int] = None, thumbnail_size: int = 256, page_size: int = 100, columns: int = 10, quality: int = 90):
+        self.directory = directory
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.thumbnail_size = thumbnail_size
+        self.page_size = page_size
+        self.columns = columns
+        self.quality = quality
+        self._executor = None
+        os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "thumbnails"), exist_ok=True)
+
+    def __enter__(self) -> "GalleryRenderer":
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_gallery_worker,
+            initargs=(image_store.cache_dir,)
+        )
+        # fork the workers now, before callers start any threads of their own
+        self._executor.submit(int).result()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._executor.shutdown()
+        self._executor = None
+
+    def _task(self, index: int, image_path: str, masks: CompactMasks) -> Tuple[Any, ...]:
+        name = f"{index:06d}_{os.path.splitext(os.path.basename(image_path))[0]}.jpg"
+        return (
+            image_path,
+            masks,
+            os.path.join(self.directory, "images", name),
+            os.path.join(self.directory, "thumbnails", name),
+            self.thumbnail_size,
+            self.quality
+        )
+
+    def render(self, items: Iterable[Tuple[str, CompactMasks]], image_directory: Optional[str] = None) -> pd.DataFrame:
+        rows, pending = [], deque()
+        for index, (image_name, masks) in enumerate(items):
+            image_path = os.path.join(image_directory, image_name) if image_directory else image_name
+            pending.append(self._executor.submit(_safe_render_gallery_image, *self._task(index, image_path, masks)))
+            # keep a bounded number of scans in flight, the items can come lazily from a store
+            while len(pending) > self.max_workers * 2:
+                rows.append(pending.popleft().result())
+        rows.extend(future.result() for future in pending)
+        # the same columns whether every scan rendered, none did or there were no scans
+        return pd.DataFrame(rows).reindex(columns=GALLERY_COLUMNS)
+
+    def _href(self, path: str) -> str:
+        return html.escape(urllib.parse.quote(os.path.relpath(path, self.directory)))
+
+    def _pages(self, rows: pd.DataFrame) -> List[pd.DataFrame]:
+        if "error" in rows:
+            rows = rows[rows["error"].isna()]
+        return [rows.iloc[start:start + self.page_size] for start in range(0, len(rows), self.page_size)]
+
+    def write_html(self, rows: pd.DataFrame, title: str = "SAM gallery") -> str:
+        pages = self._pages(rows)
+        for number, page in enumerate(pages):
+            links = []
+            if number > 0:
+                links.append(f'<a href="page-{number - 1:04d}.html">previous</a>')
+            links.append(f"page {number + 1} / {len(pages)}")
+            if number < len(pages) - 1:
+                links.append(f'<a href="page-{number + 1:04d}.html">next</a>')
+            navigation = " | ".join(links)
+
+            figures = "\n".join(
+                f'<figure><a href="{self._href(row.file)}"><img src="{self._href(row.thumbnail)}" loading="lazy"></a>'
+                f"<figcaption>{html.escape(os.path.basename(row.image))}<br>{int(row.masks)} masks</figcaption></figure>"
+                for row
+                in page.itertuples()
+            )
+            with open(os.path.join(self.directory, f"page-{number:04d}.html"), "w") as f:
+                f.write(
+                    f"<!doctype html><html><head><meta charset='utf-8'><title>{html.escape(title)}</title>"
+                    "<style>body{font-family:sans-serif} figure{display:inline-block;margin:4px;text-align:center;font-size:12px}</style>"
+                    f"</head><body><h1>{html.escape(title)}</h1><p>{navigation}</p>\n{figures}\n<p>{navigation}</p></body></html>"
+                )
+
+        index_path = os.path.join(self.directory, "index.html")
+        with open(index_path, "w") as f:
+            items = "\n".join(
+                f'<li><a href="page-{number:04d}.html">page {number + 1}</a> - {len(page)} scans</li>'
+                for number, page
+                in enumerate(pages)
+            )
+            f.write(f"<!doctype html><html><head><meta charset='utf-8'><title>{html.escape(title)}</title></head><body><h1>{html.escape(title)}</h1><ul>\n{items}\n</ul></body></html>")
+        return index_path
+
+    def write_contact_sheets(self, rows: pd.DataFrame) -> List[str]:
+        paths = []
+        for number, page in enumerate(self._pages(rows)):
+            rows_count = math.ceil(len(page) / self.columns)
+            sheet = np.full((rows_count * self.thumbnail_size, self.columns * self.thumbnail_size, 3), 255, dtype=np.uint8)
+            for position, thumbnail_file in enumerate(page["thumbnail"]):
+                thumbnail = cv2.imread(thumbnail_file)
+                y, x = divmod(position, self.columns)
+                height, width = thumbnail.shape[:2]
+                sheet[y * self.thumbnail_size:y * self.thumbnail_size + height, x * self.thumbnail_size:x * self.thumbnail_size + width] = thumbnail
+
+            path = os.path.join(self.directory, f"contact-sheet-{number:04d}.jpg")
+            cv2.imwrite(path, sheet, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            paths.append(path)
+        return paths
+
+
+with GalleryRenderer() as gallery:
+    gallery_rows = gallery.render(result_store.items())
+
+print("gallery:", gallery.write_html(gallery_rows, title=f"SAM {SAM_PROFILE} - {PD_DATASET_DIRECTORY}"))
+print(gallery.write_contact_sheets(gallery_rows))
+print(f"{len(gallery_rows)} scans, {gallery_rows.get('seconds', pd.Series(dtype=float)).sum():.1f}s of rendering, {gallery_rows['error'].notna().sum()} failed")
+
+"""## Local Inference Service
+
+Serves box / point prompts for the SAM predictor on this machine only - over HTTP on `127.0.0.1` or over a Unix socket - so other processes (a labelling tool, a script on the same box) can get masks without loading the model themselves. No network access is needed.
+
+- every request is decoded and hashed in its own handler thread and put on a bounded queue; when the queue is full the request is refused with `503` and a `Retry-After` header, so clients back off instead of piling up
+- a single model worker takes whatever arrived within `max_wait_ms`, groups the prompts by image and runs one decoder call per image (and prompt shape); the embedding comes through `embedding_cache`, so an image is encoded once no matter how many clients prompt it
+- `GET /metrics` reports p50 / p95 latency, queue depth, decoder calls and prompts per decoder call
+
+`POST /predict` takes `{"image": "<base64 jpg/png>"}` or `{"image_path": "..."}` together with `"boxes": [[x_min, y_min, x_max, y_max], ...]` and / or `"points": [[[x, y], ...], ...]` with `"point_labels"`, and returns for every prompt the masks (uncompressed COCO RLE), scores and `xyxy` bboxes.
+"""
+
+import http.client
+import json
+import socket
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from segment_anything.utils.amg import batched_mask_to_box, mask_to_rle_pytorch
+
+SAM_SERVICE_HOST = "127.0.0.1"
+SAM_SERVICE_PORT = 8765
+# set to a path to serve over a Unix socket instead of TCP
+SAM_SERVICE_SOCKET = None
+
+
+@dataclass
+class PromptRequest:
+    image_key: str
+    image_rgb: np.ndarray
+    boxes: Optional[np.ndarray]
+    points: Optional[np.ndarray]
+    point_labels: Optional[np.ndarray]
+    multimask_output: bool
+    future: Future = field(default_factory=Future, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.boxes) if self.boxes is not None else len(self.points)
+
+    @property
+    def signature(self) -> Tuple[bool, int, bool]:
+        # prompts can only share a decoder call when their tensors stack
+        return self.boxes is not None, 0 if self.points is None else self.points.shape[1], self.multimask_output
+
+
+class _SamServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # quiet, and Unix socket clients have no address to log
+        pass
+
+    def _reply(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            self._reply(200, self.server.service.metrics())
+        elif self.path == "/health":
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        if self.path != "/predict":
+            self._reply(404, {"error": f"unknown path {self.path}"})
+            return
+
+        service = self.server.service
+        start = time.perf_counter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            request = service.parse(body)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+
+        if not service.submit(request):
+            self._reply(503, {"error": "queue full"}, {"Retry-After": "1"})
+            return
+
+        try:
+            result = request.future.result(timeout=service.request_timeout)
+        except FutureTimeoutError:
+            # still queued - the batcher skips it; already running - its result is dropped
+            request.future.cancel()
+            service.count("timeouts")
+            self._reply(503, {"error": "timed out"}, {"Retry-After": "1"})
+            return
+        except Exception as e:
+            service.count("errors")
+            self._reply(500, {"error": repr(e)})
+            return
+
+        latency = time.perf_counter() - start
+        service.record_latency(latency)
+        self._reply(200, {**result, "latency_ms": latency * 1000})
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class BatchingSamService:
+    def __init__(self, predictor: CachedSamPredictor, max_queue: int = 64, max_batch_requests: int = 32, max_wait_ms: float = 5.0, max_prompts_per_call: int = 64, request_timeout: float = 60.0):
+        self.predictor = predictor
+        self.max_batch_requests = max_batch_requests
+        self.max_wait_ms = max_wait_ms
+        self.max_prompts_per_call = max_prompts_per_call
+        self.request_timeout = request_timeout
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.latencies = deque(maxlen=10_000)
+        self.counters = {"requests": 0, "rejected": 0, "timeouts": 0, "errors": 0, "batches": 0, "decoder_calls": 0, "prompts": 0}
+        self.lock = threading.Lock()
+        self.address = None
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._server = None
+
+    def parse(self, body: Dict[str, Any]) -> PromptRequest:
+        if "image" in body:
+            data = np.frombuffer(base64.b64decode(body["image"].split(",")[-1]), dtype=np.uint8)
+            image_bgr = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            if image_bgr is None:
+                raise ValueError("unreadable image")
+            image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+        elif "image_path" in body:
+            image_rgb = image_store.rgb(body["image_path"])
+        else:
+            raise ValueError("either image or image_path is required")
+
+        boxes = np.asarray(body["boxes"], dtype=np.float32).reshape(-1, 4) if body.get("boxes") else None
+        points, point_labels = None, None
+        if body.get("points"):
+            points = np.asarray(body["points"], dtype=np.float32)
+            if points.ndim != 3 or points.shape[2] != 2:
+                raise ValueError("points must be a list of [[x, y], ...] per prompt")
+            point_labels = np.asarray(body.get("point_labels") or np.ones(points.shape[:2]), dtype=np.float32)
+            if point_labels.shape != points.shape[:2]:
+                raise ValueError("point_labels must match points")
+        if boxes is None and points is None:
+            raise ValueError("at least one box or point prompt is required")
+        if boxes is not None and points is not None and len(boxes) != len(points):
+            raise ValueError("boxes and points must have the same number of prompts")
+
+        return PromptRequest(
+            image_key=self.predictor.image_key(image_rgb),
+            image_rgb=image_rgb,
+            boxes=boxes,
+            points=points,
+            point_labels=point_labels,
+            multimask_output=bool(body.get("multimask_output", False)))
+
+    def submit(self, request: PromptRequest) -> bool:
+        try:
+            self.requests.put_nowait(request)
+        except queue.Full:
+            self.count("rejected")
+            return False
+        self.count("requests")
+        return True
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def record_latency(self, seconds: float) -> None:
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def _next_batch(self) -> List[PromptRequest]:
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_requests:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _serve_batches(self) -> None:
+        while not self._stop.is_set():
+            # requests whose client timed out were cancelled, the rest can no longer be
+            batch = [request for request in self._next_batch() if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            by_image: Dict[str, List[PromptRequest]] = {}
+            for request in batch:
+                by_image.setdefault(request.image_key, []).append(request)
+
+            for requests in by_image.values():
+                try:
+                    self._predict_image(requests)
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+            self.count("batches")
+
+    def _predict_image(self, requests: List[PromptRequest]) -> None:
+        # a cache hit after the first request for this image
+        self.predictor.set_image(requests[0].image_rgb, image_key=requests[0].image_key)
+        original_size = self.predictor.original_size
+
+        by_signature: Dict[Tuple[bool, int, bool], List[PromptRequest]] = {}
+        for request in requests:
+            by_signature.setdefault(request.signature, []).append(request)
+
+        for (has_boxes, point_count, multimask_output), group in by_signature.items():
+            boxes = np.concatenate([request.boxes for request in group]) if has_boxes else None
+            points = np.concatenate([request.points for request in group]) if point_count else None
+            point_labels = np.concatenate([request.point_labels for request in group]) if point_count else None
+
+            prompts = []
+            for start in range(0, sum(len(request) for request in group), self.max_prompts_per_call):
+                end = start + self.max_prompts_per_call
+                # the transforms return float64, the prompt encoder expects float32 like SamPredictor.predict passes
+                masks, scores, _ = self.predictor.predict_torch(
+                    point_coords=None if points is None else torch.as_tensor(self.predictor.transform.apply_coords(points[start:end], original_size), dtype=torch.float, device=self.predictor.device),
+                    point_labels=None if point_labels is None else torch.as_tensor(point_labels[start:end], dtype=torch.int, device=self.predictor.device),
+                    boxes=None if boxes is None else torch.as_tensor(self.predictor.transform.apply_boxes(boxes[start:end], original_size), dtype=torch.float, device=self.predictor.device),
+                    multimask_output=multimask_output)
+                self.count("decoder_calls")
+                self.count("prompts", len(masks))
+
+                flat = masks.flatten(0, 1)
+                rles = mask_to_rle_pytorch(flat)
+                xyxy = batched_mask_to_box(flat).cpu().numpy().tolist()
+                scores = scores.cpu().numpy().tolist()
+                per_prompt = masks.shape[1]
+                for i in range(len(masks)):
+                    prompts.append((rles[i * per_prompt:(i + 1) * per_prompt], scores[i], xyxy[i * per_prompt:(i + 1) * per_prompt]))
+
+            offset = 0
+            for request in group:
+                mine = prompts[offset:offset + len(request)]
+                offset += len(request)
+                request.future.set_result({
+                    "masks": [rles for rles, _, _ in mine],
+                    "scores": [scores for _, scores, _ in mine],
+                    "bboxes": [xyxy for _, _, xyxy in mine],
+                })
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            counters = dict(self.counters)
+        return {
+            **counters,
+            "queue_depth": self.requests.qsize(),
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else None,
+            "prompts_per_decoder_call": counters["prompts"] / counters["decoder_calls"] if counters["decoder_calls"] else None,
+            "cache_hits": self.predictor.hits,
+            "cache_misses": self.predictor.misses,
+        }
+
+    def start(self, host: str = SAM_SERVICE_HOST, port: int = SAM_SERVICE_PORT, unix_socket: Optional[str] = SAM_SERVICE_SOCKET) -> "BatchingSamService":
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            self._server = _UnixHTTPServer(unix_socket, _SamServiceHandler)
+            # owner only, like the authkey file of the model server
+            os.chmod(unix_socket, 0o600)
+            self.address = unix_socket
+        else:
+            self._server = ThreadingHTTPServer((host, port), _SamServiceHandler)
+            self._server.daemon_threads = True
+            self.address = self._server.server_address[:2]
+        self._server.service = self
+
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._serve_batches, daemon=True),
+            threading.Thread(target=self._server.serve_forever, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.remove(self.address)
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._server = None
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def sam_service_request(address: Union[str, Tuple[str, int]], method: str, path: str, payload: Optional[Dict[str, Any]] = None, timeout: float = 60.0) -> Tuple[int, Dict[str, Any]]:
+    connection = _UnixHTTPConnection(address, timeout) if isinstance(address, str) else http.client.HTTPConnection(*address, timeout=timeout)
+    try:
+        body = json.dumps(payload).encode() if payload is not None else None
+        connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+# a predictor of its own, so the service never changes the image set on mask_predictor
+sam_service = BatchingSamService(CachedSamPredictor(sam, sam_model_key(MODEL_TYPE), CHECKPOINT_PATH, embedding_cache)).start()
+
+# default_box was drawn on this scan - IMAGE_PATH points at Mask.png by now
+SERVICE_IMAGE_PATH = '/content/drive/My Drive/PD Dataset/1.jpg'
+
+
+# sixteen clients prompting the same scan at once end up in a handful of decoder calls
+def _jittered_box_request(seed: int) -> Dict[str, Any]:
+    x_min, y_min = default_box['x'], default_box['y']
+    x_max, y_max = x_min + default_box['width'], y_min + default_box['height']
+    shift = np.random.default_rng(seed).integers(-20, 20, size=4)
+    return {"image_path": SERVICE_IMAGE_PATH, "boxes": [(np.array([x_min, y_min, x_max, y_max]) + shift).tolist()]}
+
+with ThreadPoolExecutor(16) as clients:
+    responses = list(clients.map(lambda seed: sam_service_request(sam_service.address, "POST", "/predict", _jittered_box_request(seed)), range(16)))
+
+print([status for status, _ in responses])
+print(sam_service_request(sam_service.address, "GET", "/metrics")[1])
+
+sam_service.stop()
+
 
 
 
@@ -427,11 +2963,13 @@ cv2_imshow(img)
 ### Utils Supporting Dataset Processing
 
 A couple of helper functions that, unfortunately, we have to write ourselves to facilitate the processing of COCO annotations.
+
+`COCOJsonUtility` scans `coco_data.images` / `coco_data.annotations` on every call, which gets quadratic when we loop over the whole split. `COCOIndex` builds the hash maps (image id → annotations, file name → image, category id → category) once, and keeps the boxes and classes of all annotations in NumPy arrays grouped by image, so the detections of an image are just a slice.
 """
 
 import numpy as np
 from dataclasses import dataclass
-from typing import List, Tuple, Union, Optional
+from typing import Any, Dict, List, Sequence, Tuple, Union, Optional
 from dataclasses_json import dataclass_json
 from supervision import Detections
 
@@ -495,6 +3033,181 @@ def load_coco_json(json_file: str) -> COCOJson:
     return COCOJson.from_dict(json_data)
 
 
+class COCOAnnotationRecord:
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table: "COCOAnnotationTable", index: int):
+        self._table = table
+        self._index = index
+
+    @property
+    def id(self) -> int:
+        return int(self._table.ids[self._index])
+
+    @property
+    def image_id(self) -> int:
+        return int(self._table.image_ids[self._index])
+
+    @property
+    def category_id(self) -> int:
+        return int(self._table.category_ids[self._index])
+
+    @property
+    def segmentation(self) -> List[List[float]]:
+        return self._table.get_segmentation(self._index)
+
+    @property
+    def area(self) -> float:
+        return float(self._table.areas[self._index])
+
+    @property
+    def bbox(self) -> Tuple[float, float, float, float]:
+        return tuple(self._table.bboxes[self._index].tolist())
+
+    @property
+    def iscrowd(self) -> int:
+        return int(self._table.iscrowd[self._index])
+
+    def to_annotation(self) -> COCOAnnotation:
+        return COCOAnnotation(
+            id=self.id,
+            image_id=self.image_id,
+            category_id=self.category_id,
+            segmentation=self.segmentation,
+            area=self.area,
+            bbox=self.bbox,
+            iscrowd=self.iscrowd
+        )
+
+    def __repr__(self) -> str:
+        return f"COCOAnnotationRecord(id={self.id}, image_id={self.image_id}, category_id={self.category_id}, bbox={self.bbox})"
+
+
+class COCOAnnotationTable(Sequence):
+    def __init__(self):
+        from array import array
+
+        self.ids = array("q")
+        self.image_ids = array("q")
+        self.category_ids = array("q")
+        self.areas = array("d")
+        self.bboxes = array("d")
+        self.iscrowd = array("b")
+        # polygons are flattened: annotation i owns rings polygon_offsets[i]:polygon_offsets[i + 1],
+        # ring j owns coords ring_offsets[j]:ring_offsets[j + 1]
+        self.coords = array("d")
+        self.ring_offsets = array("q", [0])
+        self.polygon_offsets = array("q", [0])
+        # non-polygon segmentations (RLE of iscrowd annotations) are kept as parsed
+        self.other_segmentations: Dict[int, Any] = {}
+
+    def append(self, record: Dict[str, Any], bbox: List[float]) -> None:
+        self.ids.append(record["id"])
+        self.image_ids.append(record["image_id"])
+        self.category_ids.append(record["category_id"])
+        self.areas.append(record.get("area", 0.0))
+        self.bboxes.extend(bbox)
+        self.iscrowd.append(record.get("iscrowd", 0))
+        if "segmentation" in record:
+            self.other_segmentations[len(self.ids) - 1] = record["segmentation"]
+        self.polygon_offsets.append(len(self.ring_offsets) - 1)
+
+    def end_ring(self) -> None:
+        self.ring_offsets.append(len(self.coords))
+
+    def freeze(self) -> "COCOAnnotationTable":
+        # zero-copy NumPy views over the array buffers
+        self.ids = np.frombuffer(self.ids, dtype=np.int64)
+        self.image_ids = np.frombuffer(self.image_ids, dtype=np.int64)
+        self.category_ids = np.frombuffer(self.category_ids, dtype=np.int64)
+        self.areas = np.frombuffer(self.areas, dtype=np.float64)
+        self.bboxes = np.frombuffer(self.bboxes, dtype=np.float64).reshape(-1, 4)
+        self.iscrowd = np.frombuffer(self.iscrowd, dtype=np.int8)
+        self.coords = np.frombuffer(self.coords, dtype=np.float64)
+        self.ring_offsets = np.frombuffer(self.ring_offsets, dtype=np.int64)
+        self.polygon_offsets = np.frombuffer(self.polygon_offsets, dtype=np.int64)
+        return self
+
+    def get_segmentation(self, index: int) -> List[List[float]]:
+        if index in self.other_segmentations:
+            return self.other_segmentations[index]
+
+        rings = range(self.polygon_offsets[index], self.polygon_offsets[index + 1])
+        return [
+            self.coords[self.ring_offsets[ring]:self.ring_offsets[ring + 1]].tolist()
+            for ring
+            in rings
+        ]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [COCOAnnotationRecord(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("annotation index out of range")
+        return COCOAnnotationRecord(self, int(index))
+
+
+def load_coco_json_streaming(json_file: str) -> COCOJson:
+    import ijson
+    from ijson.common import ObjectBuilder
+
+    sections = {"images.item": [], "categories.item": [], "licenses.item": []}
+    table = COCOAnnotationTable()
+    scalar_fields = {"id", "image_id", "category_id", "area", "iscrowd"}
+
+    builder, builder_prefix = None, None
+    record, bbox = None, None
+
+    with open(json_file, "rb") as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            # small objects (images, categories, licenses, RLE segmentations) are built as plain dicts
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == builder_prefix and event == "end_map":
+                    if builder_prefix == "annotations.item.segmentation":
+                        record["segmentation"] = builder.value
+                    else:
+                        sections[builder_prefix].append(builder.value)
+                    builder = None
+                continue
+
+            if prefix in sections and event == "start_map":
+                builder, builder_prefix = ObjectBuilder(), prefix
+                builder.event(event, value)
+
+            elif prefix == "annotations.item":
+                if event == "start_map":
+                    record, bbox = {}, []
+                elif event == "end_map":
+                    table.append(record, bbox)
+
+            elif prefix.startswith("annotations.item."):
+                field = prefix[len("annotations.item."):]
+                if field == "segmentation.item.item":
+                    table.coords.append(value)
+                elif field == "segmentation.item" and event == "end_array":
+                    table.end_ring()
+                elif field == "bbox.item":
+                    bbox.append(value)
+                elif field in scalar_fields and event == "number":
+                    record[field] = value
+                elif field == "segmentation" and event == "start_map":
+                    builder, builder_prefix = ObjectBuilder(), prefix
+                    builder.event(event, value)
+
+    return COCOJson(
+        images=[COCOImage(**{key: image[key] for key in COCOImage.__dataclass_fields__ if key in image}) for image in sections["images.item"]],
+        annotations=table.freeze(),
+        categories=[COCOCategory(id=category["id"], name=category["name"], supercategory=category.get("supercategory", "none")) for category in sections["categories.item"]],
+        licenses=[COCOLicense(id=coco_license["id"], name=coco_license["name"], url=coco_license.get("url", "")) for coco_license in sections["licenses.item"]]
+    )
+
+
 class COCOJsonUtility:
     @staticmethod
     def get_annotations_by_image_id(coco_data: COCOJson, image_id: int) -> List[COCOAnnotation]:
@@ -517,23 +3230,106 @@ class COCOJsonUtility:
 
     @staticmethod
     def annotations2detections(annotations: List[COCOAnnotation]) -> Detections:
-        class_id, xyxy = [], []
-
-        for annotation in annotations:
-            x_min, y_min, width, height = annotation.bbox
-            class_id.append(annotation.category_id)
-            xyxy.append([
-                x_min,
-                y_min,
-                x_min + width,
-                y_min + height
-            ])
+        xywh = np.array([annotation.bbox for annotation in annotations], dtype=float).reshape(-1, 4)
+        class_id = np.array([annotation.category_id for annotation in annotations], dtype=int)
 
         return Detections(
-            xyxy=np.array(xyxy, dtype=int),
-            class_id=np.array(class_id, dtype=int)
+            xyxy=COCOJsonUtility.xywh2xyxy(xywh),
+            class_id=class_id
         )
 
+    @staticmethod
+    def xywh2xyxy(xywh: np.ndarray) -> np.ndarray:
+        xyxy = xywh.copy()
+        xyxy[:, 2:] += xyxy[:, :2]
+        return xyxy.astype(int)
+
+
+class COCOIndex:
+    def __init__(self, coco_data: COCOJson):
+        self.coco_data = coco_data
+        self.images_by_id = {image.id: image for image in coco_data.images}
+        self.images_by_path = {image.file_name: image for image in coco_data.images}
+        self.categories_by_id = {category.id: category for category in coco_data.categories}
+
+        annotations = coco_data.annotations
+        if isinstance(annotations, COCOAnnotationTable):
+            # columns are already there when the file was loaded with `load_coco_json_streaming`
+            image_ids, xywh, class_id = annotations.image_ids, annotations.bboxes, annotations.category_ids.astype(int)
+        else:
+            image_ids = np.array([annotation.image_id for annotation in annotations], dtype=np.int64)
+            xywh = np.array([annotation.bbox for annotation in annotations], dtype=float).reshape(-1, 4)
+            class_id = np.array([annotation.category_id for annotation in annotations], dtype=int)
+
+        # group annotations by image - a stable sort keeps the original order inside each image
+        self._order = np.argsort(image_ids, kind="stable")
+        self._xyxy = COCOJsonUtility.xywh2xyxy(xywh[self._order])
+        self._class_id = class_id[self._order]
+
+        sorted_image_ids = image_ids[self._order]
+        unique_ids, starts, counts = np.unique(sorted_image_ids, return_index=True, return_counts=True)
+        self._slices = {
+            int(image_id): slice(int(start), int(start + count))
+            for image_id, start, count
+            in zip(unique_ids, starts, counts)
+        }
+
+    def get_image_by_id(self, image_id: int) -> Optional[COCOImage]:
+        return self.images_by_id.get(image_id)
+
+    def get_image_by_path(self, image_path: str) -> Optional[COCOImage]:
+        return self.images_by_path.get(image_path)
+
+    def get_category_by_id(self, category_id: int) -> Optional[COCOCategory]:
+        return self.categories_by_id.get(category_id)
+
+    def get_annotations_by_image_id(self, image_id: int) -> List[COCOAnnotation]:
+        index = self._slices.get(image_id, slice(0, 0))
+        return [self.coco_data.annotations[i] for i in self._order[index]]
+
+    def get_annotations_by_image_path(self, image_path: str) -> Optional[List[COCOAnnotation]]:
+        image = self.get_image_by_path(image_path)
+        if image:
+            return self.get_annotations_by_image_id(image.id)
+        else:
+            return None
+
+    def get_boxes_by_image_id(self, image_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        index = self._slices.get(image_id, slice(0, 0))
+        return self._xyxy[index], self._class_id[index]
+
+    def get_detections_by_image_id(self, image_id: int) -> Detections:
+        xyxy, class_id = self.get_boxes_by_image_id(image_id)
+        return Detections(
+            xyxy=xyxy.copy(),
+            class_id=class_id.copy()
+        )
+
+    def get_detections_by_image_path(self, image_path: str) -> Optional[Detections]:
+        image = self.get_image_by_path(image_path)
+        if image:
+            return self.get_detections_by_image_id(image.id)
+        else:
+            return None
+
+    def get_masks_by_image_id(self, image_id: int) -> np.ndarray:
+        image = self.get_image_by_id(image_id)
+        annotations = self.get_annotations_by_image_id(image_id)
+        masks = np.zeros((len(annotations), image.height, image.width), dtype=np.uint8)
+        for mask, annotation in zip(masks, annotations):
+            segmentation = annotation.segmentation
+            if isinstance(segmentation, dict) and isinstance(segmentation.get("counts"), list):
+                mask[:] = rle_to_mask(segmentation)
+            elif isinstance(segmentation, dict) or not segmentation:
+                # compressed RLE needs pycocotools, fall back to the box
+                x, y, w, h = np.round(annotation.bbox).astype(int)
+                mask[y:y + h, x:x + w] = 1
+            else:
+                polygons = [np.round(np.asarray(polygon).reshape(-1, 2)).astype(np.int32) for polygon in segmentation if len(polygon) >= 6]
+                if polygons:
+                    cv2.fillPoly(mask, polygons, 1)
+        return masks.view(bool)
+
 """### Download Dataset from Roboflow"""
 
 # Commented out IPython magic to ensure Python compatibility.
@@ -556,7 +3352,8 @@ ANNOTATIONS_FILE_NAME = "_annotations.coco.json"
 IMAGES_DIRECTORY_PATH = os.path.join(dataset.location, DATA_SET_SUBDIRECTORY)
 ANNOTATIONS_FILE_PATH = os.path.join(dataset.location, DATA_SET_SUBDIRECTORY, ANNOTATIONS_FILE_NAME)
 
-coco_data = load_coco_json(json_file=ANNOTATIONS_FILE_PATH)
+coco_data = load_coco_json_streaming(json_file=ANNOTATIONS_FILE_PATH)
+coco_index = COCOIndex(coco_data)
 
 CLASSES = [
     category.name
@@ -573,6 +3370,47 @@ IMAGES = [
 
 CLASSES
 
+"""### Benchmark COCO Loaders
+
+`load_coco_json` builds a `dataclasses_json` object for every annotation, `load_coco_json_streaming` streams the file with `ijson` into columnar arrays and decodes `segmentation` polygons only when they are accessed. Each loader runs in a forked process so that peak RSS is measured in isolation.
+"""
+
+import multiprocessing
+import resource
+import time
+
+
+def _run_loader(loader, json_file, connection) -> None:
+    rss_before = current_rss_bytes()
+    start = time.perf_counter()
+    data = loader(json_file)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    connection.send({
+        "loader": loader.__name__,
+        "annotations": len(data.annotations),
+        "parse_seconds": round(seconds, 3),
+        "peak_rss_mb": round((peak_rss - rss_before) / 1024 ** 2, 1)
+    })
+    connection.close()
+
+
+def benchmark_coco_loaders(json_file: str, loaders=(load_coco_json, load_coco_json_streaming)) -> List[Dict[str, Any]]:
+    context = multiprocessing.get_context("fork")
+    results = []
+    for loader in loaders:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run_loader, args=(loader, json_file, sender))
+        process.start()
+        results.append(receiver.recv())
+        process.join()
+    return results
+
+
+for result in benchmark_coco_loaders(ANNOTATIONS_FILE_PATH):
+    print(result)
+
 """### Single Image Bounding Box to Mask"""
 
 # set random seed to allow easy reproduction of the experiment
@@ -584,15 +3422,14 @@ EXAMPLE_IMAGE_NAME = random.choice(IMAGES)
 EXAMPLE_IMAGE_PATH = os.path.join(dataset.location, DATA_SET_SUBDIRECTORY, EXAMPLE_IMAGE_NAME)
 
 # load dataset annotations
-annotations = COCOJsonUtility.get_annotations_by_image_path(coco_data=coco_data, image_path=EXAMPLE_IMAGE_NAME)
-ground_truth = COCOJsonUtility.annotations2detections(annotations=annotations)
+ground_truth = coco_index.get_detections_by_image_path(image_path=EXAMPLE_IMAGE_NAME)
 
 # small hack - coco numerate classes from 1, model from 0 + we drop first redundant class from coco json
 ground_truth.class_id = ground_truth.class_id - 1
 
 # load image
-image_bgr = cv2.imread(EXAMPLE_IMAGE_PATH)
-image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+image = image_store.get(EXAMPLE_IMAGE_PATH)
+image_bgr, image_rgb = image.bgr, image.rgb
 
 # initiate annotator
 box_annotator = sv.BoxAnnotator(color=sv.Color.red())
@@ -623,6 +3460,312 @@ sv.plot_images_grid(
     titles=['source image', 'segmented image']
 )
 
+"""### Dataset-wide Bounding Box to Mask
+
+Same as above, but for every box of every image in `coco_data.images`, with the ground truth taken from `coco_index`. The image embedding is computed once per image and all of its boxes are sent to the prompt decoder in a single batched `predict_torch` call (in chunks of `box_batch_size` to bound memory). As in the single image example we keep the largest of the three masks returned for each box.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Container, Iterator, Tuple
+
+
+@dataclass
+class ThroughputStats:
+    images: int = 0
+    boxes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def images_per_sec(self) -> float:
+        return self.images / self.seconds if self.seconds else 0.0
+
+    @property
+    def boxes_per_sec(self) -> float:
+        return self.boxes / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.images} images, {self.boxes} boxes in {self.seconds:.1f}s "
+            f"({self.images_per_sec:.2f} images/sec, {self.boxes_per_sec:.2f} boxes/sec)"
+        )
+
+
+def segment_boxes(predictor: SamPredictor, image_rgb: np.ndarray, xyxy: np.ndarray, box_batch_size: int = 32, image_name: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    height, width = image_rgb.shape[:2]
+    with profiler.stage("set_image", image_name):
+        predictor.set_image(image_rgb)
+
+    masks = np.zeros((len(xyxy), height, width), dtype=bool)
+    scores = np.zeros(len(xyxy), dtype=np.float32)
+
+    for start in range(0, len(xyxy), box_batch_size):
+        boxes = torch.as_tensor(xyxy[start:start + box_batch_size], dtype=torch.float, device=predictor.device)
+        boxes = predictor.transform.apply_boxes_torch(boxes, (height, width))
+
+        with torch.no_grad(), profiler.stage("predict", image_name, prompts=len(boxes)):
+            batch_masks, batch_scores, _ = predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=boxes,
+                multimask_output=True
+            )
+
+        # keep the largest of the 3 candidate masks per box, like the single image example
+        best = batch_masks.sum(dim=(2, 3)).argmax(dim=1)
+        index = torch.arange(len(best), device=best.device)
+        masks[start:start + len(best)] = batch_masks[index, best].cpu().numpy()
+        scores[start:start + len(best)] = batch_scores[index, best].cpu().numpy()
+
+    return masks, scores
+
+
+def segment_coco_split(
+    predictor: SamPredictor,
+    coco_index: COCOIndex,
+    images_directory_path: str,
+    box_batch_size: int = 32,
+    stats: Optional[ThroughputStats] = None,
+    skip: Container[str] = ()
+) -> Iterator[Tuple[str, Detections, Detections]]:
+    stats = stats if stats is not None else ThroughputStats()
+
+    for image in coco_index.coco_data.images:
+        if image.file_name in skip:
+            continue
+        start = time.perf_counter()
+
+        ground_truth = coco_index.get_detections_by_image_id(image_id=image.id)
+        # same hack as above - coco numerate classes from 1, model from 0
+        ground_truth.class_id = ground_truth.class_id - 1
+
+        with profiler.stage("decode", image.file_name):
+            image_rgb = image_store.rgb(os.path.join(images_directory_path, image.file_name))
+
+        if len(ground_truth) > 0:
+            masks, scores = segment_boxes(predictor, image_rgb, ground_truth.xyxy, box_batch_size=box_batch_size, image_name=image.file_name)
+        else:
+            masks = np.zeros((0,) + image_rgb.shape[:2], dtype=bool)
+            scores = np.zeros(0, dtype=np.float32)
+
+        with profiler.stage("detections", image.file_name, masks=len(masks)):
+            detections = sv.Detections(
+                xyxy=sv.mask_to_xyxy(masks=masks) if len(masks) else np.zeros((0, 4)),
+                mask=masks,
+                confidence=scores,
+                class_id=ground_truth.class_id
+            )
+
+        stats.images += 1
+        stats.boxes += len(ground_truth)
+        stats.seconds += time.perf_counter() - start
+
+        yield image.file_name, ground_truth, detections
+
+
+split_stats = ThroughputStats()
+# masks are written as they come, a restarted run only segments the images that are missing
+split_masks = SegmentationStore(SEGMENTATION_STORE_DIR, {
+    "task": "coco_boxes",
+    "model": sam_model_key(MODEL_TYPE),
+    "dataset": DATA_SET_SUBDIRECTORY,
+    "box_batch_size": 32
+})
+
+for image_name, ground_truth, detections in segment_coco_split(
+    predictor=mask_predictor,
+    coco_index=coco_index,
+    images_directory_path=IMAGES_DIRECTORY_PATH,
+    stats=split_stats,
+    skip=split_masks
+):
+    split_masks.put(image_name, CompactMasks.from_detections(detections), prompt={"boxes": ground_truth.xyxy.tolist(), "class_id": ground_truth.class_id.tolist()})
+
+print(split_stats, f"({len(split_masks)} images in {split_masks.directory})")
+
+"""### Segmentation QA over the Split"""
+
+split_qa_report = SegmentationQAReport()
+
+for image_name, compact in split_masks.items():
+    image_bgr = image_store.bgr(os.path.join(IMAGES_DIRECTORY_PATH, image_name))
+    detections = compact.to_detections()
+    segmented_image = mask_annotator.annotate(scene=image_bgr.copy(), detections=detections)
+    # the reference is the union of the annotated objects, independent of SAM
+    ground_truth_masks = coco_index.get_masks_by_image_id(coco_index.get_image_by_path(image_name).id)
+    reference = ground_truth_masks.any(axis=0) if len(ground_truth_masks) else np.zeros(image_bgr.shape[:2], dtype=bool)
+    split_qa_report.add(image_name, image_bgr, segmented_image, detections.mask.any(axis=0), reference)
+
+print("QA table:", split_qa_report.save(name=DATA_SET_SUBDIRECTORY))
+split_qa_report.table().sort_values("iou").head(20)
+
+"""### Evaluation against Ground Truth
+
+`SegmentationEvaluator` scores SAM's masks against the COCO annotations of the whole split. For every image it builds the box IoU and mask IoU matrices between all predictions and all ground truth objects in one go (broadcasting for boxes, a single matrix product for masks), then matches them one-to-one with the Hungarian algorithm on mask IoU - only within the same class and only above `iou_threshold`. Matched pairs are true positives, unmatched predictions false positives, unmatched ground truth false negatives. Results are reported per image and per class as precision, recall and mean IoU over the ground truth objects (an object that was missed counts as IoU 0).
+
+Ground truth masks are rasterized from the annotation polygons with `COCOIndex.get_masks_by_image_id`.
+"""
+
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from scipy.optimize import linear_sum_assignment
+
+
+def box_iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(1, -1, 4)
+    top_left = np.maximum(a[..., :2], b[..., :2])
+    bottom_right = np.minimum(a[..., 2:], b[..., 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    union = (a[..., 2:] - a[..., :2]).prod(axis=2) + (b[..., 2:] - b[..., :2]).prod(axis=2) - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def match_detections(iou: np.ndarray, predicted_class: np.ndarray, true_class: np.ndarray, iou_threshold: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
+    if iou.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    # pairs of different classes can never be matched
+    iou = np.where(predicted_class[:, None] == true_class[None, :], iou, 0.0)
+    rows, cols = linear_sum_assignment(iou, maximize=True)
+    keep = iou[rows, cols] >= iou_threshold
+    return rows[keep], cols[keep]
+
+
+def _ratio(numerator: float, denominator: float) -> float:
+    return numerator / denominator if denominator else float("nan")
+
+
+class SegmentationEvaluator:
+    def __init__(self, iou_threshold: float = 0.5, class_names: Optional[Dict[int, str]] = None):
+        self.iou_threshold = iou_threshold
+        self.class_names = class_names or {}
+        self.rows = []
+        # one entry per ground truth object / per prediction, for the per-class numbers
+        self._true_class: List[np.ndarray] = []
+        self._true_mask_iou: List[np.ndarray] = []
+        self._true_box_iou: List[np.ndarray] = []
+        self._predicted_class: List[np.ndarray] = []
+        self._predicted_match: List[np.ndarray] = []
+
+    @staticmethod
+    def _class_id(detections: sv.Detections) -> np.ndarray:
+        if detections.class_id is None:
+            return np.zeros(len(detections), dtype=int)
+        return np.asarray(detections.class_id, dtype=int)
+
+    def add(self, image_name: str, predictions: sv.Detections, ground_truth: sv.Detections) -> Dict[str, Any]:
+        predicted_class, true_class = self._class_id(predictions), self._class_id(ground_truth)
+        box_iou = box_iou_matrix(predictions.xyxy, ground_truth.xyxy)
+        if len(predictions) and len(ground_truth):
+            mask_iou = mask_iou_matrix(predictions.mask, ground_truth.mask)
+        else:
+            mask_iou = np.zeros((len(predictions), len(ground_truth)), dtype=np.float32)
+
+        rows, cols = match_detections(mask_iou, predicted_class, true_class, self.iou_threshold)
+        true_mask_iou = np.zeros(len(ground_truth))
+        true_mask_iou[cols] = mask_iou[rows, cols]
+        true_box_iou = np.zeros(len(ground_truth))
+        true_box_iou[cols] = box_iou[rows, cols]
+        predicted_match = np.zeros(len(predictions), dtype=bool)
+        predicted_match[rows] = True
+
+        self._true_class.append(true_class)
+        self._true_mask_iou.append(true_mask_iou)
+        self._true_box_iou.append(true_box_iou)
+        self._predicted_class.append(predicted_class)
+        self._predicted_match.append(predicted_match)
+
+        tp = len(rows)
+        row = {
+            "image": image_name,
+            "predictions": len(predictions),
+            "ground_truth": len(ground_truth),
+            "tp": tp,
+            "fp": len(predictions) - tp,
+            "fn": len(ground_truth) - tp,
+            "precision": _ratio(tp, len(predictions)),
+            "recall": _ratio(tp, len(ground_truth)),
+            "mask_miou": float(true_mask_iou.mean()) if len(ground_truth) else float("nan"),
+            "box_miou": float(true_box_iou.mean()) if len(ground_truth) else float("nan"),
+        }
+        self.rows.append(row)
+        return row
+
+    def per_image(self) -> pd.DataFrame:
+        return pd.DataFrame(self.rows)
+
+    def per_class(self) -> pd.DataFrame:
+        truth = pd.DataFrame({
+            "class_id": np.concatenate(self._true_class) if self._true_class else np.zeros(0, dtype=int),
+            "mask_iou": np.concatenate(self._true_mask_iou) if self._true_mask_iou else np.zeros(0),
+            "box_iou": np.concatenate(self._true_box_iou) if self._true_box_iou else np.zeros(0),
+        })
+        predicted = pd.DataFrame({
+            "class_id": np.concatenate(self._predicted_class) if self._predicted_class else np.zeros(0, dtype=int),
+            "tp": np.concatenate(self._predicted_match) if self._predicted_match else np.zeros(0, dtype=bool),
+        })
+
+        table = truth.groupby("class_id").agg(ground_truth=("mask_iou", "size"), mask_miou=("mask_iou", "mean"), box_miou=("box_iou", "mean")).join(
+            predicted.groupby("class_id").agg(predictions=("tp", "size"), tp=("tp", "sum")),
+            how="outer"
+        ).fillna({"ground_truth": 0, "predictions": 0, "tp": 0})
+        table["precision"] = table["tp"] / table["predictions"].where(table["predictions"] > 0)
+        table["recall"] = table["tp"] / table["ground_truth"].where(table["ground_truth"] > 0)
+        table.insert(0, "class", [self.class_names.get(class_id, str(class_id)) for class_id in table.index])
+        return table.reset_index()[["class_id", "class", "ground_truth", "predictions", "tp", "precision", "recall", "mask_miou", "box_miou"]]
+
+    def summary(self) -> Dict[str, float]:
+        table = self.per_image()
+        tp, predictions, ground_truth = table["tp"].sum(), table["predictions"].sum(), table["ground_truth"].sum()
+        true_mask_iou = np.concatenate(self._true_mask_iou) if self._true_mask_iou else np.zeros(0)
+        true_box_iou = np.concatenate(self._true_box_iou) if self._true_box_iou else np.zeros(0)
+        return {
+            "images": len(table),
+            "precision": float(_ratio(tp, predictions)),
+            "recall": float(_ratio(tp, ground_truth)),
+            "mask_miou": float(true_mask_iou.mean()) if len(true_mask_iou) else float("nan"),
+            "box_miou": float(true_box_iou.mean()) if len(true_box_iou) else float("nan"),
+        }
+
+    def save(self, directory: str = QA_DIRECTORY, name: str = "evaluation") -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}_per_image.csv")
+        self.per_image().to_csv(path, index=False)
+        self.per_class().to_csv(os.path.join(directory, f"{name}_per_class.csv"), index=False)
+        return path
+
+
+# same hack as above - class ids are shifted by one against the coco categories
+split_evaluator = SegmentationEvaluator(class_names={category.id - 1: category.name for category in coco_data.categories})
+
+start = time.perf_counter()
+for image_name, compact in split_masks.items():
+    image = coco_index.get_image_by_path(image_name)
+    ground_truth = coco_index.get_detections_by_image_id(image.id)
+    ground_truth.mask = coco_index.get_masks_by_image_id(image.id)
+    ground_truth.class_id = ground_truth.class_id - 1
+
+    predictions = compact.to_detections()
+    # CompactMasks boxes include the last pixel, coco boxes do not
+    predictions.xyxy = predictions.xyxy + np.array([0, 0, 1, 1])
+    predictions.class_id = np.array(split_masks.prompt(image_name)["class_id"], dtype=int)
+    split_evaluator.add(image_name, predictions, ground_truth)
+
+print(f"{len(split_evaluator.rows)} images evaluated in {time.perf_counter() - start:.1f}s")
+print(split_evaluator.summary())
+print("evaluation:", split_evaluator.save(name=DATA_SET_SUBDIRECTORY))
+split_evaluator.per_class()
+
+"""### Stage Profile
+
+With `PROFILE_STAGES = True` this shows where the time went in all the cells above, per stage.
+"""
+
+if profiler.enabled:
+    print("stage records:", profiler.save())
+profiler.summary()
+
 """## 🏆 Congratulations
 
 ### Learning Resources
@@ -23,8 +23,12 @@ drive.mount('/content/drive')
 """
 
 import os
+import json
+import hashlib
+import time
 import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from sklearn.model_selection import train_test_split
 
@@ -32,56 +36,200 @@ directory = "/content/drive/My Drive/PD Dataset/Dataset"
 height = 200
 width = 200
 
-# Get the list of image file names in the directory
-image_files = os.listdir(directory)
-
-# List to store the loaded images
-images = []
-
-# Loop through each image file
-for file_name in image_files:
-
-    # Construct the full path of the image file
-    file_path = os.path.join(directory, file_name)
-
-    # Load the image using PIL
-    image = Image.open(file_path)
-
-    # Process the image as per your requirements. For example, resize the image:
-    image = image.resize((width, height))
-
-    # Convert the image to float datatype
-    image_float = np.array(image).astype(float)
-
-    # Normalize the image
-    image_float /= 255.0
-
-    # Append the processed image to the list
-    images.append(image_float)
-
-images = np.array(images)
+# Preprocessed uint8 copy of the dataset, on the local disk of the runtime
+dataset_cache = "/content/cache/pd_dataset_200x200.npy"
+
+
+def load_image(file_path, out):
+    # Decode, convert to grayscale and resize one image straight into its slot of the output array
+    try:
+        with Image.open(file_path) as image:
+            pixels = np.asarray(image.convert("L").resize((out.shape[1], out.shape[0])))
+    except (OSError, ValueError):
+        # Not an image, or a broken one
+        return False
+
+    if out.dtype == np.uint8:
+        out[...] = pixels
+    else:
+        # Normalize without a float64 copy of the image
+        np.divide(pixels, np.float32(255.0), out=out)
+    return True
+
+
+def list_files(directory):
+    # Get the list of files in the directory
+    file_paths = [os.path.join(directory, file_name) for file_name in sorted(os.listdir(directory))]
+    return [file_path for file_path in file_paths if os.path.isfile(file_path)]
+
+
+def load_images(directory, height, width, dtype=np.float32, max_workers=None, out=None, return_files=False):
+    file_paths = list_files(directory)
+
+    # One array for all the images, the threads write into it directly
+    if out is None:
+        out = np.empty((len(file_paths), height, width), dtype=dtype)
+    elif out.shape[0] < len(file_paths) or out.shape[1:] != (height, width):
+        raise ValueError(f"out has shape {out.shape}, need at least {(len(file_paths), height, width)}")
+
+    start = time.perf_counter()
+    # PIL releases the GIL while decoding and resizing, so threads are enough
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        loaded = list(executor.map(load_image, file_paths, out))
+
+    # Close the gaps left by skipped files in place
+    count = 0
+    for index, ok in enumerate(loaded):
+        if ok:
+            if index != count:
+                out[count] = out[index]
+            count += 1
+
+    seconds = time.perf_counter() - start
+    print(f"Loaded {count} images ({len(file_paths) - count} skipped) in {seconds:.1f}s - {count / seconds:.1f} images/sec")
+    if return_files:
+        return out[:count], [file_path for file_path, ok in zip(file_paths, loaded) if ok]
+    return out[:count]
+
+
+def directory_signature(directory):
+    # Changes when a file is added, removed or rewritten
+    digest = hashlib.sha1()
+    for file_path in list_files(directory):
+        stat = os.stat(file_path)
+        digest.update(f"{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def load_dataset_cache(directory, cache_path, height, width):
+    # The images are decoded once into a uint8 memory-mapped file plus an index,
+    # later runs (and training) read them lazily from disk
+    index_path = os.path.splitext(cache_path)[0] + ".json"
+    signature = directory_signature(directory)
+
+    if os.path.isfile(cache_path) and os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index["signature"] == signature and index["height"] == height and index["width"] == width:
+            return np.load(cache_path, mmap_mode="r")[:index["count"]]
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    out = np.lib.format.open_memmap(cache_path, mode="w+", dtype=np.uint8, shape=(len(list_files(directory)), height, width))
+    _, files = load_images(directory, height, width, out=out, return_files=True)
+    out.flush()
+    del out
+
+    with open(index_path, "w") as f:
+        json.dump({
+            "signature": signature,
+            "height": height,
+            "width": width,
+            "count": len(files),
+            "files": [os.path.basename(file_path) for file_path in files]
+        }, f)
+    return np.load(cache_path, mmap_mode="r")[:len(files)]
+
+
+images = load_dataset_cache(directory, dataset_cache, height, width)
 
 # images = images.reshape((114,600,600,3))
 print(images.shape)
 
 """### SPLITTING THE DATASET"""
 
+import tensorflow as tf
 from sklearn.model_selection import train_test_split
 
-# Shuffle the images.
-np.random.shuffle(images)
-
-# Split the images into a training set and a test set.
-(x_train, x_test) = train_test_split(images, test_size=0.25)
 
-# x_train = x_train[..., :3]
-# x_test = x_test[..., :3]
+class ImageSplit:
+    # A subset of the memory-mapped images, nothing is read until a batch is asked for
+
+    def __init__(self, images, indices):
+        self.images = images
+        # Sorted, so a pass over the split reads the file front to back
+        self.indices = np.sort(indices)
+        self._cached = {}
+        self._datasets = {}
+
+    @property
+    def shape(self):
+        return (len(self.indices), int(np.prod(self.images.shape[1:])))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def batch(self, indices):
+        # Read the file front to back, then put the rows back in the order they were asked for
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        pixels = np.empty((len(indices),) + self.images.shape[1:], dtype=self.images.dtype)
+        pixels[order] = self.images[indices[order]]
+        # Normalise per batch, the data on disk stays uint8
+        return pixels.reshape(len(indices), -1).astype(np.float32) / 255.0
+
+    def load(self):
+        return self.batch(self.indices)
+
+    def __getstate__(self):
+        # Sent to the Optuna worker processes by file name, not by value,
+        # and the tf.data pipelines are rebuilt there
+        state = {"indices": self.indices, "images": self.images}
+        if isinstance(self.images, np.memmap) and self.images.filename:
+            state["images"] = (self.images.filename, len(self.images))
+        return state
+
+    def __setstate__(self, state):
+        images = state["images"]
+        if isinstance(images, tuple):
+            path, count = images
+            images = np.load(path, mmap_mode="r")[:count]
+        self.images = images
+        self.indices = state["indices"]
+        self._cached = {}
+        self._datasets = {}
+
+    def _read(self, index):
+        return np.asarray(self.images[index])
+
+    def _pixels(self, cache):
+        # Index -> uint8 image, read in parallel on the first pass and cached for the next ones.
+        # cache=True keeps the uint8 pixels in memory, a path caches them to a file instead
+        if cache not in self._cached:
+            dataset = tf.data.Dataset.from_tensor_slices(self.indices)
+            dataset = dataset.map(
+                lambda index: tf.ensure_shape(tf.numpy_function(self._read, [index], tf.uint8), self.images.shape[1:]),
+                num_parallel_calls=tf.data.AUTOTUNE,
+                deterministic=False
+            )
+            if cache:
+                dataset = dataset.cache(cache if isinstance(cache, str) else "")
+            self._cached[cache] = dataset
+        return self._cached[cache]
+
+    def dataset(self, batch_size, shuffle=False, shuffle_buffer=1024, cache=True):
+        # The same pipeline (and cache) is handed to every Optuna trial with this batch size
+        key = (batch_size, shuffle, shuffle_buffer, cache)
+        if key not in self._datasets:
+            dataset = self._pixels(cache)
+            if shuffle:
+                dataset = dataset.shuffle(min(shuffle_buffer, len(self)), reshuffle_each_iteration=True)
+            dataset = dataset.batch(batch_size)
+            dataset = dataset.map(
+                lambda pixels: tf.reshape(tf.cast(pixels, tf.float32) / 255.0, (-1, self.shape[1])),
+                num_parallel_calls=tf.data.AUTOTUNE
+            )
+            self._datasets[key] = dataset.prefetch(tf.data.AUTOTUNE)
+        return self._datasets[key]
+
+
+# Split the image indices into a training set and a test set, the images stay on disk.
+train_indices, test_indices = train_test_split(np.arange(len(images)), test_size=0.25, shuffle=True)
+x_train = ImageSplit(images, train_indices)
+x_test = ImageSplit(images, test_indices)
 
 print(x_train.shape)
 print(x_test.shape)
 
-print(x_train)
-
 pip install optuna
 
 """### USING VARIATIONAL AUTO ENCODERS"""
@@ -94,7 +242,71 @@ from keras.optimizers import Adam,RMSprop
 from keras.models import Model
 from keras import backend as K
 from keras.datasets import mnist
+from keras.callbacks import Callback, EarlyStopping, ModelCheckpoint
 import optuna
+from joblib import Parallel, delayed
+from optuna.pruners import MedianPruner
+from optuna.trial import TrialState
+
+# Local study database, a search that was interrupted picks up from here
+study_storage = "sqlite:////content/cache/vae_optuna.db"
+study_name = "vae"
+# The pruner only starts comparing trials once this many have completed
+pruner_startup_trials = 5
+# Weights of every finished trial, so the best one is reloaded instead of trained again
+trial_weights_directory = "/content/cache/vae_trials"
+
+
+class OptunaPruningCallback(Callback):
+    # Reports the validation loss of every epoch to Optuna and stops the trial when the pruner says so
+
+    def __init__(self, trial, monitor='val_loss'):
+        super().__init__()
+        self.trial = trial
+        self.monitor = monitor
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        if value is None:
+            return
+        self.trial.report(float(value), step=epoch)
+        if self.trial.should_prune():
+            raise optuna.TrialPruned(f"pruned at epoch {epoch}")
+
+
+def load_study(storage, name):
+    # A generous lock timeout, several worker processes write to the same SQLite file
+    storage = optuna.storages.RDBStorage(storage, engine_kwargs={"connect_args": {"timeout": 300}})
+    return optuna.create_study(
+        study_name=name,
+        storage=storage,
+        load_if_exists=True,
+        direction='minimize',
+        pruner=MedianPruner(n_startup_trials=pruner_startup_trials, n_warmup_steps=10)
+    )
+
+
+def finished_trials(study, states=(TrialState.COMPLETE, TrialState.PRUNED)):
+    return len(study.get_trials(deepcopy=False, states=states))
+
+
+def optimize_worker(vae_model, storage, name, n_trials, threads):
+    # Runs in its own process and runs exactly n_trials trials of the shared study
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(2)
+        for gpu in tf.config.list_physical_devices('GPU'):
+            tf.config.experimental.set_memory_growth(gpu, True)
+    except RuntimeError:
+        # TensorFlow was already initialised in this process
+        pass
+
+    # No in-memory tf.data cache in a worker, every worker would hold its own copy of the images.
+    # They all read the same memmap instead, and share its pages through the OS page cache
+    vae_model.dataset_cache = False
+
+    study = load_study(storage, name)
+    study.optimize(vae_model.objective, n_trials=n_trials)
 
 class create_vae_model:
 
@@ -104,6 +316,8 @@ class create_vae_model:
         self.hidden_units = hidden_units
         self.latent_dim = latent_dim
         self.dropout_rate = dropout_rate
+        # Cache the decoded images in memory (True), in a file (a path) or not at all (False)
+        self.dataset_cache = True
 
     def encoder(self):
 
@@ -177,54 +391,148 @@ class create_vae_model:
 
         vae.compile(optimizer=optimizer)
 
-        # Train the model
-        vae.fit(x_train, batch_size=batch_size, epochs=num_epochs, validation_data=(x_test, None))
-
-        # Calculate the validation loss
-        validation_loss = vae.evaluate(x_test, batch_size=batch_size)
+        # Stop a losing trial early, stop a trial that stopped improving, and keep the weights
+        # of its best epoch. restore_best_weights only restores them when EarlyStopping actually
+        # stops the training, so the checkpoint is what keeps them when all epochs run
+        weights_path = os.path.join(self.weights_directory, f"trial-{trial.number}.weights.h5")
+        callbacks = [
+            OptunaPruningCallback(trial),
+            EarlyStopping(monitor='val_loss', patience=10),
+            ModelCheckpoint(weights_path, monitor='val_loss', save_best_only=True, save_weights_only=True)
+        ]
+
+        # Train the model on the tf.data pipelines, they are shared by the trials of a worker
+        train_data = self.x_train.dataset(batch_size, shuffle=True, cache=self.dataset_cache)
+        val_data = self.x_val.dataset(batch_size, cache=self.dataset_cache)
+        vae.fit(train_data, epochs=num_epochs, validation_data=val_data, callbacks=callbacks, verbose=0)
+
+        # Calculate the validation loss of the best epoch, the one the checkpoint kept
+        if os.path.exists(weights_path):
+            vae.load_weights(weights_path)
+            trial.set_user_attr("weights", weights_path)
+        validation_loss = vae.evaluate(val_data, verbose=0)
 
         return validation_loss
 
-    def train(self, x_train, x_val):
-
-        # Define the study for hyperparameter optimization
-        study = optuna.create_study(direction='minimize')
-
-        # Run the hyperparameter optimization
-        study.optimize(self.objective, n_trials=10)
+    def train(self, x_train, x_val, n_trials=10, n_workers=None, storage=study_storage, name=study_name):
+
+        # The data every trial trains and validates on
+        self.x_train = x_train
+        self.x_val = x_val
+
+        # Define the study for hyperparameter optimization, or load the one that was interrupted
+        self.weights_directory = os.path.join(trial_weights_directory, name)
+        os.makedirs(self.weights_directory, exist_ok=True)
+        study = load_study(storage, name)
+
+        # Run the hyperparameter optimization until n_trials trials have completed or been pruned.
+        # MedianPruner does not prune anything before pruner_startup_trials trials have completed,
+        # so a search that started all of its trials at once would never prune. Run the startup
+        # trials here first, one after the other, so every trial after them can be pruned
+        remaining = n_trials - finished_trials(study)
+        startup = min(max(0, pruner_startup_trials - finished_trials(study, (TrialState.COMPLETE,))), remaining)
+        if startup > 0:
+            study.optimize(self.objective, n_trials=startup)
+            remaining = n_trials - finished_trials(study)
+
+        # Then run the rest in worker processes that share the study. The remaining trials are
+        # split between the workers up front, so the search never runs more than n_trials
+        if remaining > 0:
+            n_workers = min(n_workers or os.cpu_count(), remaining)
+            threads = max(1, os.cpu_count() // n_workers)
+            shares = [remaining // n_workers + (worker < remaining % n_workers) for worker in range(n_workers)]
+            Parallel(n_jobs=n_workers, backend="loky")(
+                delayed(optimize_worker)(self, storage, name, share, threads)
+                for share in shares
+            )
+            study = load_study(storage, name)
+        pruned = finished_trials(study, (TrialState.PRUNED,))
+        print(f"{pruned} of {len(study.trials)} trials pruned")
+        if pruned == 0 and len(study.trials) > pruner_startup_trials:
+            print("No trial was pruned, check that the pruner is given the validation loss of every epoch")
 
         # Get the best hyperparameters
-        best_params = study.best_params
+        best_trial = study.best_trial
+        best_params = best_trial.params
 
-        # Build the VAE model with the best hyperparameters
+        # Rebuild the VAE and load the best trial's weights, the architecture is the same for every trial
         vae = self.model()
         vae.compile(optimizer=best_params['optimizer'])
-        vae.fit(x_train, batch_size=best_params['batch_size'], epochs=best_params['num_epochs'], validation_data=(x_val, None))
-        decoder_ = self.decoder()
-
-        return vae, best_params, decoder_
+        weights_path = best_trial.user_attrs.get("weights")
+        if weights_path and os.path.exists(weights_path):
+            vae.load_weights(weights_path)
+        else:
+            # A trial from before weights were saved, train it again
+            vae.fit(x_train.dataset(best_params['batch_size'], shuffle=True), epochs=best_params['num_epochs'], validation_data=x_val.dataset(best_params['batch_size']))
 
-x_train = x_train.reshape(-1,40000)
-x_test = x_test.reshape(-1,40000)
+        # The encoder and decoder share their layers with the trained VAE
+        return vae, best_params, vae.get_layer('encoder'), vae.get_layer('decoder')
 
+# Each image is a flat 40000-d vector, x_train.shape already reports it that way
 print(x_train.shape)
 print(x_test.shape)
 
-input_dim = 40000
+input_dim = x_train.shape[1]
 num_hidden_layers = 5
 hidden_units = 256
 latent_dim = 10
 dropout_rate = 0.2
 
 vae_model = create_vae_model(input_dim, num_hidden_layers, hidden_units, latent_dim, dropout_rate)
-best_vae_model, best_hyperparameters, prediction_decoder= vae_model.train(x_train, x_test)
+
+"""### INPUT PIPELINE BENCHMARK
+
+Steps/sec of one VAE on the in-memory NumPy path (Keras slices the array batch by batch) against the `tf.data` pipeline (parallel reads from the memmap, cached after the first epoch, shuffled and prefetched). The first epoch is left out - it includes graph tracing and filling the cache. Both run on the first `benchmark_images` training images, so the NumPy path doesn't load the whole split into memory. Set `run_pipeline_benchmark = True` to run it.
+"""
+
+import math
+
+
+class EpochTimer(Callback):
+
+    def on_train_begin(self, logs=None):
+        self.seconds = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.seconds.append(time.perf_counter() - self.start)
+
+
+def steps_per_second(vae_model, data, batch_size, epochs=4):
+    vae = vae_model.model()
+    vae.compile(optimizer=Adam())
+    timer = EpochTimer()
+
+    if isinstance(data, np.ndarray):
+        vae.fit(data, batch_size=batch_size, epochs=epochs, callbacks=[timer], verbose=0)
+        steps = math.ceil(len(data) / batch_size)
+    else:
+        vae.fit(data, epochs=epochs, callbacks=[timer], verbose=0)
+        steps = int(data.cardinality())
+
+    return steps / np.median(timer.seconds[1:])
+
+
+run_pipeline_benchmark = False
+benchmark_batch_size = 32
+benchmark_images = 1024
+
+if run_pipeline_benchmark:
+    benchmark_split = ImageSplit(images, x_train.indices[:benchmark_images])
+    numpy_steps = steps_per_second(vae_model, benchmark_split.load(), benchmark_batch_size)
+    dataset_steps = steps_per_second(vae_model, benchmark_split.dataset(benchmark_batch_size, shuffle=True), benchmark_batch_size)
+    print(f"numpy: {numpy_steps:.1f} steps/sec, tf.data: {dataset_steps:.1f} steps/sec ({dataset_steps / numpy_steps:.2f}x)")
+
+best_vae_model, best_hyperparameters, prediction_encoder, prediction_decoder = vae_model.train(x_train, x_test)
 
 """### PLOTTING THE SAMPLES"""
 
 import numpy as np
 import matplotlib.pyplot as plt
 
-# Assuming you have trained the VAE model and have the trained decoder model available
+# prediction_decoder is the decoder of the best trial's VAE
 
 # Generate random samples
 num_samples = 10  # Number of random samples to generate